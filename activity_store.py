@@ -0,0 +1,268 @@
+import os
+import pickle
+import time
+from array import array
+
+LOCAL_STORE = "timetable.pkl"  # the downloads of the PC
+
+_MONTHS = {
+    month: number for number, month in enumerate(
+        ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+         "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1
+    )
+}
+
+
+def parse_asctime(date: str) -> int:
+    """
+    Faster than time.strptime for the fixed format of time.asctime
+    :param date: a date as written by time.asctime, in local time
+    :return: the epoch
+    """
+    _, month, day, clock, year = date.split()
+    hour, minute, second = clock.split(':')
+    return int(time.mktime((
+        int(year), _MONTHS[month], int(day),
+        int(hour), int(minute), int(second), 0, 0, -1
+    )))
+
+
+class ActivityStore:
+    """
+    Columnar store of the activities. The start of each activity is kept as an
+    epoch and its duration in seconds, both in typed arrays, and the task is
+    kept as an integer id interned in a table of task names, so that a long
+    history costs a few bytes per activity instead of three boxed objects.
+    """
+
+    def __init__(self):
+        self._starts = array('q')
+        self._durations = array('I')
+        self._task_ids = array('I')
+        self._task_names = []
+        self._task_index = dict()
+
+    def _intern(self, task: str) -> int:
+        task_id = self._task_index.get(task, None)
+        if task_id is None:
+            task_id = len(self._task_names)
+            self._task_names.append(task)
+            self._task_index[task] = task_id
+        return task_id
+
+    def append(self, task: str, start: int, duration: int = 0):
+        """
+        Adds an activity at the end of the store
+        :param task: the name of the task
+        :param start: the epoch of the start of the activity
+        :param duration: the duration in seconds
+        :return:
+        """
+        self._task_ids.append(self._intern(task))
+        self._starts.append(int(start))
+        self._durations.append(int(duration))
+
+    def set_duration(self, duration: int, index: int = -1):
+        self._durations[index] = int(duration)
+
+    def get_duration(self, index: int = -1) -> int:
+        return self._durations[index]
+
+    def set_start(self, start: int, index: int = -1):
+        self._starts[index] = int(start)
+
+    def get_start(self, index: int = -1) -> int:
+        return self._starts[index]
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, index):
+        return (
+            self._task_names[self._task_ids[index]],
+            self._starts[index],
+            self._durations[index]
+        )
+
+    def __iter__(self):
+        names = self._task_names
+        for task_id, start, duration in zip(
+                self._task_ids, self._starts, self._durations
+        ):
+            yield names[task_id], start, duration
+
+    def since(self, start: int):
+        """
+        Copies the activities from a sequence number, the sequence number of
+        an activity being its index in the store
+        :param start: the first sequence number to copy
+        :return: a new store with the activities from start
+        """
+        store = ActivityStore()
+        store._starts = self._starts[start:]
+        store._durations = self._durations[start:]
+        store._task_ids = self._task_ids[start:]
+        store._task_names = list(self._task_names)
+        store._task_index = dict(self._task_index)
+        return store
+
+    def merge(self, start: int, other):
+        """
+        Replaces the activities from a sequence number by the ones of another
+        store, typically the result of `since` on the board
+        :param start: the sequence number of the first activity of other
+        :param other: the store to merge
+        :return:
+        """
+        if start > len(self):
+            raise ValueError(
+                f"cannot merge at {start}, only {len(self)} activities"
+            )
+        del self._starts[start:]
+        del self._durations[start:]
+        del self._task_ids[start:]
+        ids = [self._intern(task) for task in other._task_names]
+        self._task_ids.extend(ids[i] for i in other._task_ids)
+        self._starts.extend(other._starts)
+        self._durations.extend(other._durations)
+
+    @property
+    def tasks(self) -> list:
+        return list(self._task_names)
+
+    def to_tuple(self):
+        """
+        Converts the store to the former (activity, absolute time, index)
+        tables
+        :return: the three lists
+        """
+        return (
+            self._durations.tolist(),
+            [time.asctime(time.localtime(s)) for s in self._starts],
+            [self._task_names[i] for i in self._task_ids]
+        )
+
+    @classmethod
+    def from_tuple(cls, data):
+        """
+        Migrates the former (activity, absolute time, index) tables, where the
+        start of each activity is a `time.asctime` string
+        :param data: the three lists
+        :return: the new store
+        """
+        store = cls()
+        activity_table, absolute_time_table, index_table = data
+        for task, date, duration in zip(
+                index_table, absolute_time_table, activity_table
+        ):
+            store.append(task, parse_asctime(date), duration)
+        return store
+
+    def columns(self):
+        """
+        :return: the table of task names and the task id, start and duration
+        arrays
+        """
+        return self._task_names, self._task_ids, self._starts, self._durations
+
+    @classmethod
+    def from_columns(cls, task_names, task_ids, starts, durations):
+        """
+        Builds a store from the columns returned by `columns`
+        :param task_names: the table of task names
+        :param task_ids: the task ids, as an array or as bytes
+        :param starts: the starts, as an array or as bytes
+        :param durations: the durations, as an array or as bytes
+        :return: the new store
+        """
+        store = cls()
+        for task in task_names:
+            store._intern(task)
+        for attribute, values in (
+                ("_task_ids", task_ids),
+                ("_starts", starts),
+                ("_durations", durations)
+        ):
+            column = getattr(store, attribute)
+            if not isinstance(values, array):
+                column.frombytes(values)
+            elif values.typecode == column.typecode:
+                setattr(store, attribute, values)
+            else:
+                column.extend(values)
+        return store
+
+    def __getstate__(self):
+        return {
+            "starts": self._starts.tobytes(),
+            "durations": self._durations.tobytes(),
+            "task_ids": self._task_ids.tobytes(),
+            "task_names": self._task_names,
+        }
+
+    def __setstate__(self, state):
+        store = self.from_columns(
+            state["task_names"], state["task_ids"], state["starts"],
+            state["durations"]
+        )
+        self.__dict__.update(store.__dict__)
+
+
+def download_cursor(mirror: dict):
+    """
+    :param mirror: the downloads of a board on the PC, a dict of its store,
+    its cursor and, once known, its history and the offset of the history
+    in the store
+    :return: the value of the send command for the next download, the bare
+    cursor for a board which does not tell its history
+    """
+    if mirror.get("history") is None:
+        return mirror["cursor"]
+    return {"cursor": mirror["cursor"], "history": mirror["history"]}
+
+
+def merge_download(mirror: dict, data: dict) -> int:
+    """
+    Merges the reply of the board to the send command in the store of its
+    mirror. When the history of the board was reset, the new history is
+    appended after the finished activities of the former one, which are then
+    only on the PC, instead of replacing them.
+    :param mirror: see download_cursor, updated
+    :param data: the reply to the send command
+    :return: the index in the store of the first merged activity
+    """
+    history = data.get("history")
+    known = mirror.get("history")
+    if history is None or known is None:
+        # nothing to compare: a board going back lost its history, unless
+        # it used to tell it
+        reset = known is None and data["start"] < mirror["cursor"]
+    else:
+        reset = history != known
+    offset = mirror.get("offset", 0)
+    if reset:
+        offset += mirror["cursor"]
+    start = offset + data["start"]
+    mirror["store"].merge(start, data["records"])
+    mirror["cursor"] = data["cursor"]
+    mirror["offset"] = offset
+    mirror["history"] = history or known
+    return start
+
+
+def load_local_store() -> dict:
+    """
+    Loads the activities already downloaded from the board
+    :return: the store, the cursor, history and offset of the downloads,
+    see download_cursor, and the number of activities already exported to
+    the timetable
+    """
+    if not os.path.isfile(LOCAL_STORE):
+        return {"store": ActivityStore(), "cursor": 0, "exported": 0}
+    with open(LOCAL_STORE, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_local_store(state: dict):
+    with open(LOCAL_STORE, 'wb') as f:
+        pickle.dump(state, f)
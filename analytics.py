@@ -0,0 +1,226 @@
+#  Local analytics store of the server: the downloaded activities are merged
+#  in an SQLite database, along with per-day and per-week rollups of each
+#  task, so reports do not go through the timetable.
+#  usage: python analytics.py [today|week|month|year|import]
+#         python analytics.py since YYYY-MM-DD [YYYY-MM-DD]
+
+import sqlite3
+import sys
+import time
+
+from activity_store import load_local_store
+from logger import logger
+
+ANALYTICS_FILE = "analytics.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS activities (
+    board TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    task_id INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    duration INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    week TEXT NOT NULL,
+    PRIMARY KEY (board, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS activities_start ON activities (start);
+CREATE TABLE IF NOT EXISTS daily (
+    day TEXT NOT NULL,
+    task_id INTEGER NOT NULL,
+    seconds INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, task_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS weekly (
+    week TEXT NOT NULL,
+    task_id INTEGER NOT NULL,
+    seconds INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (week, task_id)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS activity_added AFTER INSERT ON activities
+BEGIN
+    INSERT INTO daily VALUES (NEW.day, NEW.task_id, NEW.duration, 1)
+    ON CONFLICT (day, task_id) DO UPDATE
+    SET seconds = seconds + excluded.seconds, count = count + 1;
+    INSERT INTO weekly VALUES (NEW.week, NEW.task_id, NEW.duration, 1)
+    ON CONFLICT (week, task_id) DO UPDATE
+    SET seconds = seconds + excluded.seconds, count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS activity_removed AFTER DELETE ON activities
+BEGIN
+    UPDATE daily SET seconds = seconds - OLD.duration, count = count - 1
+    WHERE day = OLD.day AND task_id = OLD.task_id;
+    DELETE FROM daily
+    WHERE day = OLD.day AND task_id = OLD.task_id AND count = 0;
+    UPDATE weekly SET seconds = seconds - OLD.duration, count = count - 1
+    WHERE week = OLD.week AND task_id = OLD.task_id;
+    DELETE FROM weekly
+    WHERE week = OLD.week AND task_id = OLD.task_id AND count = 0;
+END;
+"""
+
+
+def day_of(epoch: int) -> str:
+    return time.strftime('%Y-%m-%d', time.localtime(epoch))
+
+
+def week_of(epoch: int) -> str:
+    return time.strftime('%G-W%V', time.localtime(epoch))
+
+
+class AnalyticsStore:
+    """
+    SQLite store of the activities of one or several boards. Each activity
+    is keyed by its board and its sequence number on the board, so merging a
+    download twice changes nothing. Triggers keep the seconds and count of
+    each task per day and per week up to date, an activity being counted on
+    the day and week of its start. A report over a period reads the rollups
+    only, a few rows per day whatever the number of activities.
+    """
+
+    def __init__(self, path=ANALYTICS_FILE):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+        self._task_ids = dict(
+            (name, task_id)
+            for task_id, name in self._db.execute("SELECT id, name FROM tasks")
+        )
+
+    def _task_id(self, name: str) -> int:
+        task_id = self._task_ids.get(name)
+        if task_id is None:
+            task_id = self._db.execute(
+                "INSERT INTO tasks (name) VALUES (?)", (name,)
+            ).lastrowid
+            self._task_ids[name] = task_id
+        return task_id
+
+    def merge(self, start: int, records, board=''):
+        """
+        Replaces the activities of a board from a sequence number, the same
+        way as ActivityStore.merge
+        :param start: the sequence number of the first activity of records
+        :param records: the downloaded activities, an ActivityStore
+        :param board: the name of the board
+        :return:
+        """
+        task_names, task_ids, starts, durations = records.columns()
+        with self._db:
+            ids = [self._task_id(name) for name in task_names]
+            self._db.execute(
+                "DELETE FROM activities WHERE board = ? AND seq >= ?",
+                (board, start)
+            )
+            self._db.executemany(
+                "INSERT INTO activities VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (board, start + i, ids[task_id], begin, duration,
+                     day_of(begin), week_of(begin))
+                    for i, (task_id, begin, duration)
+                    in enumerate(zip(task_ids, starts, durations))
+                )
+            )
+        logger.info(f"{len(records)} activities merged in {self.path}")
+
+    def hours_per_task(self, since: str, until: str) -> dict:
+        """
+        :param since: the first day, as YYYY-MM-DD
+        :param until: the last day, included
+        :return: the hours spent on each task over the days
+        """
+        return dict(self._db.execute(
+            "SELECT name, SUM(seconds) / 3600. FROM daily "
+            "JOIN tasks ON tasks.id = task_id "
+            "WHERE day BETWEEN ? AND ? GROUP BY name ORDER BY 2 DESC",
+            (since, until)
+        ))
+
+    def per_day(self, since: str, until: str, task=None) -> list:
+        """
+        :param since: the first day, as YYYY-MM-DD
+        :param until: the last day, included
+        :param task: only this task, None for every task
+        :return: the (day, task, hours, activity count) rows
+        """
+        return self._rollup("daily", "day", since, until, task)
+
+    def per_week(self, since: str, until: str, task=None) -> list:
+        """
+        :param since: the first week, as YYYY-Www
+        :param until: the last week, included
+        :param task: only this task, None for every task
+        :return: the (week, task, hours, activity count) rows
+        """
+        return self._rollup("weekly", "week", since, until, task)
+
+    def _rollup(self, table, period, since, until, task):
+        query = (
+            f"SELECT {period}, name, seconds / 3600., count FROM {table} "
+            f"JOIN tasks ON tasks.id = task_id "
+            f"WHERE {period} BETWEEN ? AND ?"
+        )
+        parameters = [since, until]
+        if task is not None:
+            query += " AND name = ?"
+            parameters.append(task)
+        return self._db.execute(
+            query + f" ORDER BY {period}, name", parameters
+        ).fetchall()
+
+    def __len__(self):
+        count, = self._db.execute("SELECT COUNT(*) FROM activities").fetchone()
+        return count
+
+    def close(self):
+        self._db.close()
+
+
+def period(name: str) -> tuple:
+    """
+    :param name: today, week, month or year
+    :return: the first and last days of the current period
+    """
+    now = time.localtime()
+    today = time.strftime('%Y-%m-%d', now)
+    if name == "today":
+        return today, today
+    if name == "week":
+        return day_of(time.time() - now.tm_wday * 86400), today
+    if name == "month":
+        return time.strftime('%Y-%m-01', now), today
+    if name == "year":
+        return time.strftime('%Y-01-01', now), today
+    raise ValueError(f"unknown period {name}")
+
+
+def run(argv):
+    analytics = AnalyticsStore()
+    command = argv[0] if argv else "month"
+    if command == "import":
+        analytics.merge(0, load_local_store()["store"])
+        analytics.close()
+        return
+    if command == "since":
+        since = argv[1]
+        until = argv[2] if len(argv) > 2 else period("today")[1]
+    else:
+        since, until = period(command)
+    tic = time.perf_counter()
+    hours = analytics.hours_per_task(since, until)
+    elapsed = time.perf_counter() - tic
+    print(f"hours per task from {since} to {until}:")
+    for task, total in hours.items():
+        print(f"  {task:<30} {total:8.2f}")
+    print(f"({elapsed * 1e3:.2f} ms over {len(analytics)} activities)")
+    analytics.close()
+
+
+if __name__ == '__main__':
+    run(sys.argv[1:])
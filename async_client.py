@@ -0,0 +1,187 @@
+# -- coding: utf-8 --
+import asyncio
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from async_communication import AsyncCommunicationChannel
+from client import CHECKPOINT_EVERY, Client, TRANSPORT, date_argument
+from communication import backoff_delays
+from logger import logger
+from transport import transport_from_url
+
+
+class AsyncClient(Client):
+    """
+    Client running on a single asyncio event loop: the commands of the
+    channel, the tags read and the checkpoints of the running activity are
+    tasks of the loop. The blocking RFID calls run in one executor thread
+    that lives as long as the client, instead of a thread per tag change.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="rfid"
+        )
+        # created by run, on the loop: before Python 3.10 an asyncio.Event
+        # is bound to the loop of the creating thread
+        self._reading = None
+        super(AsyncClient, self).__init__()
+
+    def _setup_channel(self):
+        self.channel = AsyncCommunicationChannel(
+            side='Board',
+            transport=transport_from_url(TRANSPORT) if TRANSPORT else None
+        )
+
+    def start_reading(self):
+        # the tags are read by a task of the loop, started by run
+        pass
+
+    async def run(self):
+        self._reading = asyncio.Event()
+        self._reading.set()
+        tasks = [
+            asyncio.create_task(self._read_loop()),
+            asyncio.create_task(self._checkpoint_loop()),
+        ]
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._channel_thread.join
+            )
+            await self._command_loop()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.stop_updating()
+            if self._journal is not None:
+                self._journal.close()
+
+    async def _command_loop(self):
+        delays = backoff_delays()
+        while True:
+            try:
+                logger.info("> Checking hand")
+                await self.channel.check_hand()
+                logger.info("> Connected")
+                delays = backoff_delays()
+                while not self.channel.is_closed:
+                    request_id, name, value = await self.channel.read_request()
+                    logger.info("command %s", name)
+                    reply = await self._run_command(name, value)
+                    if reply is not None and not self.channel.is_closed:
+                        await self.channel.send_sensor(*reply, request_id)
+            except socket.timeout as e:
+                logger.warning(f"connection lost: {e}")
+            except OSError as err:
+                # lost connection, or the transport is not available yet
+                delay = next(delays)
+                logger.warning(
+                    f"Connection lost: {err!r}, waiting {delay} s"
+                )
+                await asyncio.sleep(delay)
+            finally:
+                self.channel.cleanup()
+
+    async def _run_command(self, name, value):
+        """
+        Runs a command of the PC, see Client._run_command
+        :return: the reply (name, value), ("error", reason) if the command
+        failed, None for a command without reply
+        """
+        try:
+            return await self._handle(name, value)
+        except Exception as err:
+            logger.warning(f"command {name} failed")
+            logger.exception(err)
+            return "error", repr(err)
+
+    async def _handle(self, name, value):
+        """
+        Runs a command of the PC
+        :return: the reply (name, value), None for a command without reply
+        """
+        if name == "read":
+            self._reading.set()
+        elif name == "write":
+            self._write(value)
+            self._reading.set()
+        elif name == "send":
+            return "data", self.data_since(value)
+        elif name == "enroll":
+            self.enroll(value)
+            self._reading.set()
+        elif name == "enrollment":
+            return "enrollment", self.enrollment_report()
+        elif name == "stats":
+            return "stats", self.stats()
+        elif name == "stop":
+            if value == "update":
+                self.stop_updating()
+                self._reading.set()
+            elif value == "read":
+                self._reading.clear()
+            elif value == "enroll":
+                self.stop_enrollment()
+            else:
+                sys.exit(0)
+        elif name == "disconnect":
+            self.channel.cleanup()
+        elif name == "set_time":
+            logger.info(f"setting time to {value}")
+            offset = time.time() - time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                "sudo", "date", "-s", date_argument(value)
+            )
+            await process.wait()
+            self._clock_changed(offset)
+        elif name == "batch":
+            return "batch", [
+                await self._run_command(command, argument)
+                for command, argument in value
+            ]
+        return None
+
+    async def _read_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._reading.wait()
+            tag = await loop.run_in_executor(self._executor, self.reader.read)
+            if not self._reading.is_set() or tag is None:
+                continue
+            uid, detected_at = tag
+            if self._pending_task is not None:
+                self._record_new_task(uid, self._pending_task)
+                self._pending_task = None
+            elif self.enrolling:
+                self._enroll_tag(uid, detected_at)
+            elif not uid == self._last_id:
+                self.record_new_activity(uid)
+                self.reader.record_latency(detected_at)
+
+    def _start_checkpoints(self):
+        # the checkpoints are a task of the loop, started by run
+        pass
+
+    async def _checkpoint_loop(self):
+        if CHECKPOINT_EVERY is None:
+            return
+        while True:
+            await asyncio.sleep(CHECKPOINT_EVERY)
+            with self._activity_lock:
+                if self.activity_running:
+                    self._checkpoint()
+
+    def __del__(self):
+        self._executor.shutdown(wait=False)
+        self.rc522.cleanup()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(AsyncClient().run())
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        logger.info("stopping device")
@@ -0,0 +1,229 @@
+import asyncio
+import itertools
+import secrets
+from collections import OrderedDict
+
+from codec import CODECS, negotiate_codec
+from communication import BaseChannel, TIMEOUT_READ
+from framing import COMPRESSIONS, negotiate_compression, read_message_async, \
+    write_message
+from logger import logger
+from transport import RfcommTransport
+from bluetooth_manager import PCBluetoothManager, BoardBluetoothManager
+
+
+class _StreamWriterFile:
+    """
+    File-like object over an asyncio.StreamWriter, the writes are buffered by
+    the transport until drained
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer = writer
+
+    def write(self, data):
+        self._writer.write(data)
+        return len(data)
+
+
+class AsyncCommunicationChannel(BaseChannel):
+    """
+    asyncio version of the CommunicationChannel, with the same messages on
+    the wire. The methods of BaseChannel return coroutines, to be awaited.
+    """
+
+    def __init__(self, side='PC', bluetooth_manager=None, transport=None):
+        super(AsyncCommunicationChannel, self).__init__()
+        self.side = side
+        self.is_PC = side == 'PC'
+        if transport is None and bluetooth_manager is None:
+            bluetooth_manager = PCBluetoothManager() if self.is_PC \
+                else BoardBluetoothManager()
+        self.transport = transport or RfcommTransport(bluetooth_manager)
+        self._reader = None
+        self._writer = None
+        # created by the first hand check, on the running loop: before
+        # Python 3.10 they are bound to the loop of the creating thread
+        self.send_lock = None
+        self.compression = None
+        self.codec = None
+        # the replies are not resumed, the session only tells the PC that
+        # the board knows "resume"
+        self.session = secrets.token_hex(8)
+        self._request_ids = itertools.count(1)
+        self._replies = OrderedDict()
+        self._replies_condition = None
+        self._receive_task = None
+
+    async def check_hand(self):
+        loop = asyncio.get_running_loop()
+        if self.send_lock is None:
+            self.send_lock = asyncio.Lock()
+            self._replies_condition = asyncio.Condition()
+        logger.info(f'Hand checking ({self.side} side)...')
+        if self.is_PC:
+            _socket = self.transport.make_socket()
+        else:
+            _socket = self.transport.listen()
+        _socket.setblocking(False)
+        try:
+            if self.is_PC:
+                await asyncio.wait_for(
+                    loop.sock_connect(_socket, self.transport.address),
+                    TIMEOUT_READ
+                )
+                self.transport.configure(_socket)
+                logger.info(' [connected]')
+                self._reader, self._writer = await asyncio.open_connection(
+                    sock=_socket
+                )
+                _, name, info = await read_message_async(self._reader)
+                self.compression = negotiate_compression(
+                    info.get("compression", ())
+                )
+                self.codec = negotiate_codec(info.get("codecs", ()))
+                await self._send_object(
+                    'checkhand reply', {
+                        "compression": self.compression,
+                        "codec": self.codec,
+                        "session": self.session,
+                    }
+                )
+                self._receive_task = asyncio.create_task(self._receive())
+            else:
+                connection, _ = await loop.sock_accept(_socket)
+                _socket.close()
+                self.transport.configure(connection)
+                self._reader, self._writer = await asyncio.open_connection(
+                    sock=connection
+                )
+                logger.info(' [accepted connection]')
+                info = {
+                    "task": "time",
+                    "compression": list(COMPRESSIONS),
+                    "codecs": list(CODECS),
+                    "session": self.session,
+                }
+                await self._send_object('checkhand info', info)
+                _, name, reply = await read_message_async(self._reader)
+                self.compression = reply["compression"]
+                self.codec = reply.get("codec", None)
+            logger.info(
+                f' [compression: {self.compression}, codec: {self.codec}]'
+            )
+            self.connected = True
+        except Exception as err:
+            _socket.close()
+            self.cleanup()
+            raise err
+        logger.info(' [done]')
+
+    async def disconnect(self):
+        if self.connected:
+            try:
+                await self.send_command('disconnect')
+            except Exception as e:
+                logger.exception(e)
+            self.cleanup()
+        else:
+            logger.info("Channel already disconnected")
+
+    def cleanup(self):
+        logger.info(
+            'Cleaning up communication channel ({} side)'.format(self.side)
+        )
+        self.connected = False
+        if self._receive_task is not None:
+            self._receive_task.cancel()
+            self._receive_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._reader = None
+
+    @property
+    def is_closed(self):
+        return self._writer is None or self._writer.is_closing()
+
+    async def request(self, name, value=None):
+        request_id = await self.send_command(name, value)
+        return await self.read_sensor(request_id=request_id)
+
+    async def _send_object(self, name: str, value=None, stream=False,
+                           request_id=None):
+        if request_id is None:
+            request_id = next(self._request_ids)
+        async with self.send_lock:
+            write_message(
+                _StreamWriterFile(self._writer), request_id, name, value,
+                self.codec, self.compression if stream else None
+            )
+            await self._writer.drain()
+        if name == 'disconnect':
+            self.connected = False
+        return request_id
+
+    async def _receive(self):
+        """
+        Receiving task of the PC: dispatches the replies of the board until
+        the connection is closed
+        :return:
+        """
+        try:
+            while True:
+                request_id, name, value = await read_message_async(
+                    self._reader, self.codec
+                )
+                async with self._replies_condition:
+                    self._replies[request_id] = (name, value)
+                    self._replies_condition.notify_all()
+        except (asyncio.IncompleteReadError, OSError) as err:
+            logger.warning(f"Connection lost while reading: {err}")
+            self.connected = False
+            async with self._replies_condition:
+                self._replies_condition.notify_all()
+
+    def _ready_reply(self, request_id):
+        if request_id is None and self._replies:
+            return self._replies.popitem(last=False)[1]
+        if request_id in self._replies:
+            return self._replies.pop(request_id)
+        if not self.connected:
+            raise ConnectionAbortedError
+        return None
+
+    async def _read_object(self, wait=True, request_id=None):
+        if not self.is_PC:
+            _, name, value = await self._read_request()
+            return name, value
+        async with self._replies_condition:
+            if not wait:
+                return self._ready_reply(request_id)
+            return await asyncio.wait_for(
+                self._replies_condition.wait_for(
+                    lambda: self._ready_reply(request_id)
+                ),
+                TIMEOUT_READ
+            )
+
+    async def _read_request(self):
+        """
+        Board side: reads the next command. The board keeps no reply to
+        resume, a "resume" of a reply not received at all runs its command
+        again, a partly received one starts over.
+        :return: (request id, name, value)
+        """
+        while True:
+            try:
+                request_id, name, value = await read_message_async(
+                    self._reader, self.codec
+                )
+            except asyncio.IncompleteReadError:
+                raise ConnectionAbortedError
+            if name != "resume":
+                return request_id, name, value
+            if not value["chunks"]:
+                return (value["request_id"], *value["command"])
+            await self._send_object(
+                "resume failed", request_id=value["request_id"]
+            )
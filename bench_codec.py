@@ -0,0 +1,69 @@
+#  Compares the codecs of the channel: encode and decode time and size of
+#  each kind of message exchanged by the board and the PC.
+#  usage: python bench_codec.py [number of activities in the history]
+
+import sys
+import time
+import timeit
+
+from activity_store import ActivityStore
+from codec import CODECS
+
+
+def make_history(n: int) -> ActivityStore:
+    store = ActivityStore()
+    start = int(time.time()) - n * 600
+    for i in range(n):
+        store.append(f"task {i % 25}", start + i * 600, 60 + i % 3600)
+    return store
+
+
+def messages(n: int) -> dict:
+    history = make_history(n)
+    return {
+        "read": None,
+        "write": "a new task to register",
+        "set_time": int(time.time()),
+        "send": {"cursor": 12345, "history": "0123456789abcdef"},
+        "batch": [
+            ("set_time", int(time.time())), ("read", None), ("send", 12345)
+        ],
+        "checkhand info": {
+            "task": "time",
+            "compression": ["zlib", "none"],
+            "codecs": list(CODECS),
+        },
+        "data": {
+            "start": 0,
+            "cursor": len(history),
+            "records": history,
+            "history": "0123456789abcdef",
+        },
+    }
+
+
+def bench(n: int):
+    print(f"history of {n} activities")
+    print(f"{'message':<16}{'codec':<8}{'bytes':>10}"
+          f"{'encode (us)':>14}{'decode (us)':>14}")
+    for name, value in messages(n).items():
+        for codec in CODECS.values():
+            x = codec.dumps(name, value)
+            number, _ = timeit.Timer(
+                lambda: codec.dumps(name, value)
+            ).autorange()
+            encode = timeit.timeit(
+                lambda: codec.dumps(name, value), number=number
+            )
+            decode = timeit.timeit(
+                lambda: codec.loads(name, x), number=number
+            )
+            print(
+                f"{name:<16}{codec.name:<8}{len(x):>10}"
+                f"{encode / number * 1e6:>14.2f}"
+                f"{decode / number * 1e6:>14.2f}"
+            )
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,121 @@
+#  Benchmark of the logging pipeline: time spent in the thread calling the
+#  logger, with the handlers writing on the calling thread as before and
+#  with the queue and its background writer, on a fast disk and on a slow
+#  one like the SD card of the board.
+#  usage: python bench_logging.py [number of messages]
+
+import logging
+import os
+import sys
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+
+from logger import make_handlers, queue_logger
+
+
+class SlowFileHandler(RotatingFileHandler):
+    """
+    File handler taking 1 ms per record, as a slow SD card
+    """
+
+    def emit(self, record):
+        time.sleep(.001)
+        super(SlowFileHandler, self).emit(record)
+
+
+def handlers(path, stream, slow) -> list:
+    log_handler, stream_handler = make_handlers(path, stream)
+    if slow:
+        slow_handler = SlowFileHandler(path, maxBytes=0xfffff, backupCount=5)
+        slow_handler.setLevel(log_handler.level)
+        slow_handler.setFormatter(log_handler.formatter)
+        log_handler.close()
+        log_handler = slow_handler
+    return [log_handler, stream_handler]
+
+
+def direct_logger(name, handlers_):
+    """
+    The former pipeline: the handlers write on the calling thread
+    """
+    _logger = logging.getLogger(name)
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
+    for handler in handlers_:
+        _logger.addHandler(handler)
+    return _logger
+
+
+def summary(values) -> str:
+    values = sorted(values)
+    return (
+        f"mean {sum(values) / len(values) * 1e6:8.2f} us, "
+        f"p99 {values[int(.99 * (len(values) - 1))] * 1e6:8.2f} us, "
+        f"max {values[-1] * 1e6:9.2f} us"
+    )
+
+
+def time_calls(log, n: int) -> list:
+    uid = [0x10, 0x20, 0x30, 0x40, 0x50]
+    durations = []
+    for i in range(n):
+        tic = time.perf_counter()
+        log(uid, i)
+        durations.append(time.perf_counter() - tic)
+    return durations
+
+
+def bench(directory, stream, n, slow):
+    label = "slow disk" if slow else "fast disk"
+    direct = direct_logger(f"direct {label}", handlers(
+        os.path.join(directory, f"direct {label}.log"), stream, slow
+    ))
+    durations = time_calls(
+        lambda uid, i: direct.info(f"tag {uid} recorded, read {i}"), n
+    )
+    print(f"{label}, direct  : {summary(durations)}")
+
+    queued, listener = queue_logger(f"queued {label}", handlers(
+        os.path.join(directory, f"queued {label}.log"), stream, slow
+    ))
+    tic = time.perf_counter()
+    durations = time_calls(
+        lambda uid, i: queued.info("tag %s recorded, read %d", uid, i), n
+    )
+    logged = time.perf_counter() - tic
+    listener.stop()  # waits for the writer to empty the queue
+    written = time.perf_counter() - tic
+    print(f"{label}, queued  : {summary(durations)}")
+    print(
+        f"  {n} messages logged in {logged * 1e3:.1f} ms, written in "
+        f"{written * 1e3:.1f} ms"
+    )
+
+
+def bench_gated(n, stream):
+    gated, listener = queue_logger(
+        "gated", [logging.StreamHandler(stream)], logging.INFO
+    )
+    table = {i: f"task {i}" for i in range(100)}
+    durations = time_calls(
+        lambda uid, i: gated.debug(f"checkpoint of {uid}: {table}"), n
+    )
+    print(f"debug below level, f-string: {summary(durations)}")
+    durations = time_calls(
+        lambda uid, i: gated.debug("checkpoint of %s: %s", uid, table), n
+    )
+    print(f"debug below level, lazy    : {summary(durations)}")
+    listener.stop()
+
+
+def main(n: int):
+    with tempfile.TemporaryDirectory() as directory, \
+            open(os.devnull, 'w') as stream:
+        bench(directory, stream, n, slow=False)
+        bench(directory, stream, min(n, 2000), slow=True)
+        bench_gated(n, stream)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
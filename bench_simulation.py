@@ -0,0 +1,105 @@
+#  End-to-end benchmarks of the board client on the simulated hardware:
+#  tag-to-record latency of tag swaps, persistence cost of a checkpoint of
+#  the running activity and download time against the size of the history.
+#  usage: python bench_simulation.py [largest history]
+
+import logging
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from bench_codec import make_history
+from logger import logger
+from simulation import SimulatedClient
+
+TAGS = [[0x10, 0x20, 0x30, 0x40, i] for i in range(4)]
+
+
+def summary(values) -> str:
+    values = sorted(values)
+    return (
+        f"mean {sum(values) / len(values) * 1e3:8.3f} ms, "
+        f"median {values[len(values) // 2] * 1e3:8.3f} ms, "
+        f"max {values[-1] * 1e3:8.3f} ms"
+    )
+
+
+def bench_tag_swaps(client: SimulatedClient, swaps=20):
+    for i, uid in enumerate(TAGS):
+        client._lookup_table.register(uid, f"task {i}")
+    latencies = []
+    for i in range(swaps):
+        uid = TAGS[i % len(TAGS)]
+        client.rc522.present(uid)
+        deadline = time.monotonic() + 5
+        while client._last_id != uid and time.monotonic() < deadline:
+            time.sleep(.001)
+        latencies.append(time.monotonic() - client.rc522.presented_at)
+        # random pause, not to stay in phase with the poll window
+        time.sleep(.2 + random.random() * .1)
+    print(f"tag swap to record ({swaps} swaps): {summary(latencies)}")
+    print(f"  first read to record: {client.reader.latency_report()}")
+
+
+def bench_persistence(client: SimulatedClient, sizes, checkpoints=200):
+    client.stop_updating()
+    for n in sizes:
+        client._history.merge(0, make_history(n))
+        client._start_activity(TAGS[0], "task 0")
+        tic = time.perf_counter()
+        for _ in range(checkpoints):
+            client._checkpoint()
+        journal = (time.perf_counter() - tic) / checkpoints
+        tic = time.perf_counter()
+        for _ in range(checkpoints // 10):
+            with open("full_table.pkl", 'wb') as f:
+                pickle.dump(client._activity.to_tuple(), f)
+        full = (time.perf_counter() - tic) / (checkpoints // 10)
+        client._end_activity()
+        print(
+            f"checkpoint with {n:>7} activities: journal "
+            f"{journal * 1e6:9.1f} us,"
+            f" full pickle {full * 1e6:11.1f} us"
+        )
+
+
+def bench_download(client: SimulatedClient, sizes):
+    channel = client.pc_channel()
+    channel.check_hand()
+    try:
+        for n in sizes:
+            client._history.merge(0, make_history(n))
+            tic = time.perf_counter()
+            _, data = channel.request("send", 0)
+            full = time.perf_counter() - tic
+            tic = time.perf_counter()
+            _, data = channel.request("send", data["cursor"] - 10)
+            incremental = time.perf_counter() - tic
+            print(
+                f"download of {n:>7} activities: full {full * 1e3:8.2f} ms,"
+                f" last 10 {incremental * 1e3:8.2f} ms"
+            )
+    finally:
+        channel.disconnect()
+
+
+def main(largest: int):
+    logger.setLevel(logging.WARNING)
+    sizes = [n for n in (100, 1000, 10000, 100000, 1000000) if n <= largest]
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        client = SimulatedClient()
+        threading.Thread(target=client.run, daemon=True).start()
+        bench_tag_swaps(client)
+        bench_persistence(client, sizes)
+        bench_download(client, sizes)
+        client.stop_reading()
+        client._journal.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -1,36 +1,132 @@
 #  Use to get the list of paired devices on the user computer.
 #  Depending on with OS we can use the same methode.
 
+import json
+import os
 import subprocess
-
-import bluetooth
+import threading
+import time
 
 from logger import logger
 
 NAME = 'RFIDTIMETRACKER'
+DEVICE_CACHE = "bluetooth_devices.json"
+CACHE_TTL = 24 * 3600  # s, a scan is done in background past it
 
 
 class PCBluetoothManager:
-    _bluetooth_paired_devices = dict()
+    """
+    Addresses of the boards, by device name. The boards already found are
+    kept in a cache file, so they are known at once on the next launch. The
+    discovery runs in a background thread when the cache is older than its
+    TTL, and the manager is only waited for when no board is known yet.
+    """
+
+    def __init__(self, cache_path=DEVICE_CACHE, ttl=CACHE_TTL):
+        """
+        :param cache_path: the file of the devices already found
+        :param ttl: the age of the cache after which it is refreshed, in
+        seconds
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._bluetooth_paired_devices = dict()
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        scanned_at = self._load_cache()
+        if not self._bluetooth_paired_devices \
+                or time.time() - scanned_at > ttl:
+            self.refresh()
+
+    def _load_cache(self) -> float:
+        """
+        :return: the time of the scan of the cache, 0 if there is no cache
+        """
+        if not os.path.isfile(self.cache_path):
+            return 0
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            self._bluetooth_paired_devices.update(cache["devices"])
+            return cache["scanned_at"]
+        except (ValueError, KeyError) as err:
+            logger.warning(f"Ignoring bad device cache: {err!r}")
+            return 0
+
+    def _save_cache(self):
+        with self._lock:
+            devices = dict(self._bluetooth_paired_devices)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"scanned_at": time.time(), "devices": devices}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def _discover(self):
+        import bluetooth  # PyBluez, only needed on the PC
 
-    def __init__(self):
         #  we set the duration to 1 to get a fast search, we only get the
         #  already paired devices. We want the name and the address but
         #  not the class.
-        for device in bluetooth.discover_devices(
+        try:
+            devices = bluetooth.discover_devices(
                 duration=1, lookup_names=True, lookup_class=False
-        ):
-            address, name = device
-            if NAME in name.upper():
-                self._bluetooth_paired_devices[name] = address
+            )
+        except Exception as err:
+            logger.warning("Bluetooth discovery failed")
+            logger.exception(err)
+            return
+        with self._lock:
+            for address, name in devices:
+                if NAME in name.upper():
+                    self._bluetooth_paired_devices[name] = address
+        self._save_cache()
+        logger.info(
+            f"{len(self._bluetooth_paired_devices)} boards known after "
+            f"discovery"
+        )
+
+    def refresh(self) -> threading.Thread:
+        """
+        Starts a discovery in background, unless one is running
+        :return: the thread of the discovery
+        """
+        with self._lock:
+            if self._refresh_thread is None \
+                    or not self._refresh_thread.is_alive():
+                self._refresh_thread = threading.Thread(
+                    target=self._discover, name="discovery", daemon=True
+                )
+                self._refresh_thread.start()
+            return self._refresh_thread
+
+    def rescan(self):
+        """
+        Discovers the devices and waits for the result, when the known
+        addresses failed
+        :return:
+        """
+        self.refresh().join()
+
+    def _wait_known(self):
+        thread = self._refresh_thread
+        if not self._bluetooth_paired_devices and thread is not None:
+            thread.join()
 
     @property
     def name_mac(self):
-        return self._bluetooth_paired_devices
+        self._wait_known()
+        with self._lock:
+            return dict(self._bluetooth_paired_devices)
 
     def get_mac_address(self):
         return self.name_mac.get(NAME, None)
 
+    def get_mac_addresses(self) -> dict:
+        """
+        :return: the MAC address of every board found, by device name
+        """
+        return self.name_mac
+
     @property
     def macs(self):
         return self.name_mac.values()
@@ -1,64 +1,152 @@
 # -- coding: utf-8 --
-import os.path
+import signal
 import socket
 import subprocess
 import sys
-import pickle
-
-import RPi.GPIO as GPIO
-from pirc522 import RFID
 import time
 import threading
 
-from communication import CommunicationChannel
+from communication import CommunicationChannel, backoff_delays
+from journal import ActivityJournal
 from logger import logger
-from bluetooth_manager import BoardBluetoothManager
+from metrics import metrics, profiled
+from rfid_reader import TagReader
+from task_registry import Enrollment, TaskRegistry
+from transport import transport_from_url
+
+# low latency reading of the tags, see TagReader
+READER_SETTINGS = {
+    "poll_window": .1,  # s
+    "debounce": 2,  # consecutive reads
+    "duplicate_window": 2.,  # s
+}
+
+# the duration of the running activity is persisted every CHECKPOINT_EVERY
+# seconds, None to persist it only when the activity stops
+CHECKPOINT_EVERY = 300  # s
 
-GPIO.setmode(GPIO.BOARD)
-GPIO.setwarnings(False)
+# None for RFCOMM, else e.g. "tcp://0.0.0.0:4242" to be reached over Wi-Fi
+TRANSPORT = None
 
-debug_uid = str([136, 4, 114, 215, 41])
+# e.g. "client.prof" to profile the command loop with cProfile, None not to
+PROFILE_FILE = None
 
-LOOKUP_FILE = "lookup_table.pkl"
-if not os.path.isfile(LOOKUP_FILE):
-    with open(LOOKUP_FILE, 'wb') as lookup_file:
-        pickle.dump({debug_uid: "DEBUG"}, lookup_file)
 
-ACTIVITY_TABLE = "activity_table.pkl"
-if not os.path.isfile(ACTIVITY_TABLE):
-    with open(ACTIVITY_TABLE, 'wb') as activity_file:
-        pickle.dump(([], [], []), activity_file)
+def date_argument(value) -> str:
+    """
+    :param value: an epoch, or a date string from a former server
+    :return: the date argument of `date -s`
+    """
+    if isinstance(value, (int, float)):
+        return f"@{int(value)}"
+    return value
 
 
 class Client:
     """
     Client class to record the time using NFC tags. The tasks are in a lookup
-    table to match an uid with a human-readable task. Each task of the session
-    and its associated time are stored in two different lists, sharing the same
-    index, to indicate the number of tasks in the current session. As long as
-    the tag does not change, the time increases, even if the tag is removed !
+    table to match an uid with a human-readable task. Each task of the
+    session, its start and its duration are stored in a columnar activity
+    store. As long as the tag does not change, the time increases, even if the
+    tag is removed ! The duration of the running activity is computed when
+    the activity is read or sent, it is written to disk when the activity
+    stops and, in case of power loss, at a low-frequency checkpoint.
+
+    The startup is staged so that the tags are read as soon as possible: the
+    RFID device and the task registry are set up first and the reading
+    starts, while the history is loaded and the Bluetooth is brought up in
+    background. The duration of each stage is kept in `startup_report`.
     """
-    rc522 = RFID()
     _last_id = None
-    _tic_task = -float('inf')  # start of the task
-    with open(LOOKUP_FILE, 'rb') as f:
-        _lookup_table = pickle.load(f)
-    with open(ACTIVITY_TABLE, 'rb') as f:
-        _activity_tuple = pickle.load(f)
-        print(_activity_tuple)
-    _activity_table, _absolute_time_table, _index_table = _activity_tuple
+    _tic_task = -float('inf')  # monotonic time of the start of the task
 
     is_reading = True
-    is_updating = True
     is_writing = False
 
     def __init__(self):
-        # setup bluetooth
-        self.channel = CommunicationChannel(side='Board')
+        self._boot = time.monotonic()
+        self.startup_report = dict()
+        self.channel = None
         self._read_thread = None
-        self._update_time_thread = None
+        self._running = False
+        self._activity_lock = threading.Lock()  # start, stop and durations
+        self._checkpoint_thread = None
+        self._closing = threading.Event()
+        self._journal = None
+        self._enrollment = None
+        self._pending_task = None  # task to register with the next tag
+        self._history = None
+        self._history_loaded = threading.Event()
+        tic = time.monotonic()
+        self._setup_rfid()
+        self.startup_report["rfid"] = time.monotonic() - tic
+        self._start_stage("history", self._load_history)
+        self._channel_thread = self._start_stage(
+            "bluetooth", self._setup_channel
+        )
         self.start_reading()
 
+    def _start_stage(self, stage: str, target):
+        """
+        Runs a stage of the startup in background
+        :param stage: the name of the stage in the startup report
+        :param target: the function of the stage
+        :return: the thread of the stage
+        """
+        def run():
+            tic = time.monotonic()
+            target()
+            self.startup_report[stage] = time.monotonic() - tic
+            logger.info(
+                f"startup: {stage} ready in {self.startup_report[stage]:.3f}s"
+            )
+
+        thread = threading.Thread(target=run, name=stage, daemon=True)
+        thread.start()
+        return thread
+
+    def _setup_rfid(self):
+        # hardware libraries, only available on the board
+        import RPi.GPIO as GPIO
+        from pirc522 import RFID
+
+        GPIO.setmode(GPIO.BOARD)
+        GPIO.setwarnings(False)
+        self.rc522 = RFID()
+        self.reader = TagReader(self.rc522, **READER_SETTINGS)
+        self._lookup_table = TaskRegistry()
+
+    def _load_history(self):
+        try:
+            self._journal = ActivityJournal()
+            self._history = self._journal.recover()
+            logger.info(f"{len(self._history)} activities recorded")
+        finally:
+            self._history_loaded.set()
+
+    def _setup_channel(self):
+        self.channel = CommunicationChannel(
+            side='Board',
+            transport=transport_from_url(TRANSPORT) if TRANSPORT else None
+        )
+
+    def _wait_history(self):
+        """
+        Waits for the history and its journal to be recovered
+        :return:
+        """
+        self._history_loaded.wait()
+        if self._history is None:
+            raise RuntimeError("the history could not be loaded")
+
+    @property
+    def _activity(self):
+        """
+        The history, once loaded
+        """
+        self._wait_history()
+        return self._history
+
     def stop_reading(self):
         self.is_reading = False
         if self._read_thread is not None and self._read_thread.is_alive():
@@ -71,6 +159,14 @@ class Client:
         self._read_thread.start()
 
     def run(self):
+        """
+        Serves the commands of the PC. When the connection is lost, the board
+        waits for the PC to connect again, the replies interrupted meanwhile
+        are then resumed by the channel.
+        :return:
+        """
+        self._channel_thread.join()
+        delays = backoff_delays()
         while True:
             try:
                 while True:
@@ -78,39 +174,31 @@ class Client:
                     self.channel.check_hand()
                     if self.channel.connected:
                         logger.info("> Connected")
+                        delays = backoff_delays()
                         break
                 while not self.channel.is_closed:
-                    logger.info("reading command")
-                    _command = self.channel.read_command()
-                    logger.info(_command)
+                    logger.debug("reading command")
+                    _command = self.channel.read_request()
+                    logger.info("command %s", _command and _command[1])
                     if _command is not None:
-                        name, value = _command
+                        request_id, name, value = _command
                     else:
                         continue
-                    if name == "read":
-                        if not self.is_reading:
-                            self.start_reading()
-                    elif name == "write":
-                        self._write(value)
-                    elif name == "send":
-                        self._send_data()
-                    elif name == "stop":
-                        if value == "update":
-                            self.stop_updating()
-                            self.start_reading()
-                        elif value == "read":
-                            self.stop_reading()
-                        else:
-                            sys.exit(0)
-                    elif name == "disconnect":
-                        self.channel.cleanup()
-                    elif name == "set_time":
-                        logger.info(f"setting time to {value}")
-                        subprocess.call(["sudo", "date",  "-s", value])
+                    reply = self._run_command(name, value)
+                    if reply is not None and not self.channel.is_closed:
+                        self.channel.send_sensor(*reply, request_id)
             except KeyboardInterrupt:
                 break
             except socket.timeout:
                 logger.warning("timeout")
+            except OSError as err:
+                # lost connection, or the transport is not available yet:
+                # the errors of the commands are replies, see _run_command
+                delay = next(delays)
+                logger.warning(
+                    f"Connection lost: {err!r}, waiting {delay} s"
+                )
+                time.sleep(delay)
             except Exception as e:
                 logger.exception(e)
                 break
@@ -118,51 +206,187 @@ class Client:
                 if self.channel is not None:
                     self.channel.cleanup()
 
+    def _run_command(self, name, value):
+        """
+        Runs a command of the PC, an error of the command is sent back to the
+        PC instead of ending the connection
+        :return: the reply (name, value), ("error", reason) if the command
+        failed, None for a command without reply
+        """
+        try:
+            return self._handle(name, value)
+        except Exception as err:
+            logger.warning(f"command {name} failed")
+            logger.exception(err)
+            return "error", repr(err)
+
+    def _handle(self, name, value):
+        """
+        Runs a command of the PC
+        :param name: the name of the command
+        :param value: the value of the command
+        :return: the reply (name, value), None for a command without reply
+        """
+        if name == "read":
+            if not self.is_reading:
+                self.start_reading()
+        elif name == "write":
+            # the reading thread registers the task with the next tag
+            self._write(value)
+            if not self.is_reading:
+                self.start_reading()
+        elif name == "send":
+            return "data", self.data_since(value)
+        elif name == "enroll":
+            self.enroll(value)
+            if not self.is_reading:
+                self.start_reading()
+        elif name == "enrollment":
+            return "enrollment", self.enrollment_report()
+        elif name == "stats":
+            return "stats", self.stats()
+        elif name == "stop":
+            if value == "update":
+                self.stop_updating()
+                self.start_reading()
+            elif value == "read":
+                self.stop_reading()
+            elif value == "enroll":
+                self.stop_enrollment()
+            else:
+                sys.exit(0)
+        elif name == "disconnect":
+            self.channel.cleanup()
+        elif name == "set_time":
+            self.set_time(value)
+        elif name == "batch":
+            # the commands run in order, their replies are sent at once
+            return "batch", [
+                self._run_command(command, argument)
+                for command, argument in value
+            ]
+        return None
+
     def _read(self):
+        logger.info("> Waiting to read new tag")
         while self.is_reading:
-            logger.info("> Waiting to read new tag")
-            uid = self._read_tag()  # blocking call
+            tag = self.reader.read()  # blocks at most a poll window
             if not self.is_reading:  # check if still reading
                 break
-            if uid is not None:
-                if not uid == self._last_id:
+            if tag is not None:
+                uid, detected_at = tag
+                if self._pending_task is not None:
+                    self._record_new_task(uid, self._pending_task)
+                    self._pending_task = None
+                elif self.enrolling:
+                    self._enroll_tag(uid, detected_at)
+                elif not uid == self._last_id:
                     self.record_new_activity(uid)
-            time.sleep(1)
+                    self.reader.record_latency(detected_at)
 
     def _write(self, task):
+        """
+        Registers a task with the next tag read, instead of starting an
+        activity
+        :param task: the name of the task
+        :return:
+        """
+        if self._pending_task is not None:
+            raise RuntimeError(f"already writing {self._pending_task}")
         self.stop_updating()
-        self.stop_reading()
+        self._pending_task = task
         logger.info(f"> Waiting for new tag to write {task}")
-        uid = self._read_tag()
-        if uid is not None:
-            self._record_new_task(uid, task)
-
-    def _read_tag(self):
-        self.rc522.wait_for_tag()  # blocking call
-        error, tag_type = self.rc522.request()
-        if not error:
-            error, uid = self.rc522.anticoll()
-            if not error:
-                if str(uid) not in self._lookup_table.keys():
-                    logger.info(f"unknown tag: {uid}")
-                # if uid == debug_uid:
-                #     self.__debug_record()
-                return uid
-        return None
 
-    def _send_data(self):
-        if self.channel is not None and not self.channel.is_closed:
-            self.channel.send_sensor(
-                "data", self.data
-            )
+    def enroll(self, tasks):
+        """
+        Starts the enrollment of tags: the next tags read are matched with
+        the tasks, in order, instead of starting activities. The reading goes
+        on between the tags and the registry is written once at the end.
+        :param tasks: the names of the tasks
+        :return:
+        """
+        self.stop_enrollment()
+        self.stop_updating()
+        self._last_id = None
+        self._pending_task = None
+        self._enrollment = Enrollment(self._lookup_table, tasks)
+        logger.info(f"> Waiting for {len(tasks)} tags to enroll")
+
+    @property
+    def enrolling(self) -> bool:
+        return self._enrollment is not None and not self._enrollment.done
+
+    def _enroll_tag(self, uid: list, detected_at: float):
+        task = self._enrollment.assign(uid, detected_at)
+        if task is not None:
+            logger.info("tag %s enrolled for %s", uid, task)
+
+    def stop_enrollment(self):
+        if self._enrollment is not None:
+            self._enrollment.stop()
+
+    def enrollment_report(self):
+        """
+        :return: the report of the last enrollment, see Enrollment.report,
+        None if there was none
+        """
+        if self._enrollment is None:
+            return None
+        return self._enrollment.report()
+
+    def stats(self) -> dict:
+        """
+        :return: the runtime metrics, along with the startup report and the
+        tag-to-record latencies of the reader
+        """
+        return {
+            **metrics.snapshot(),
+            "startup": self.startup_report,
+            "tag latency": self.reader.latency_report(),
+        }
+
+    @property
+    def activity_running(self):
+        return self._running
+
+    def data_since(self, cursor=None):
+        """
+        Gets the activities recorded after a cursor, along with the cursor
+        to use for the next download. The running activity is still sent but
+        is not behind the new cursor, so it is sent again until it ends.
+        :param cursor: the cursor of the previous download, along with the
+        history it belongs to as {"cursor", "history"}, nothing to get
+        everything
+        :return: the start, the new cursor, the activities from start and the
+        identity of the history
+        """
+        self._wait_history()
+        with self._activity_lock:
+            self._update_duration()
+            history = self._journal.history
+            if isinstance(cursor, dict):
+                # a cursor in another history means nothing here
+                cursor = cursor["cursor"] \
+                    if cursor.get("history") in (None, history) else 0
+            start = cursor if isinstance(cursor, int) else 0
+            if start > len(self._activity):  # history lost on the board
+                start = 0
+            new_cursor = len(self._activity)
+            if self.activity_running:
+                new_cursor -= 1
+            start = min(start, new_cursor)
+            return {
+                "start": start,
+                "cursor": new_cursor,
+                "records": self._activity.since(start),
+                "history": history,
+            }
 
     @property
     def data(self):
-        return (
-            self._activity_table,
-            self._absolute_time_table,
-            self._index_table
-        )
+        with self._activity_lock:
+            self._update_duration()
+            return self._activity.to_tuple()
 
     def __debug_record(self):
         time.sleep(10)
@@ -175,9 +399,7 @@ class Client:
         :param task: the task it is associated to
         :return:
         """
-        self._lookup_table[str(uid)] = task
-        with open(LOOKUP_FILE, 'wb') as f:
-            pickle.dump(self._lookup_table, f)  # save the new uuid
+        self._lookup_table.register(uid, task)  # save the new uuid
         self._last_id = None
         logger.info(f"New task registered: {task}")
 
@@ -187,54 +409,144 @@ class Client:
         :param uid: the uid of the tag to start the task
         :return:
         """
-        task = self._lookup_table.get(str(uid), None)
+        task = self._lookup_table.get(uid, None)
         if task is None:  # known tag?
             logger.warning(f"No task registered for tag {uid}")
             return
-        logger.info(f"Starting task {task}")
-        self.stop_updating()
-        self._index_table.append(task)
-        self._absolute_time_table.append(time.asctime())
-        self._activity_table.append(0)
+        logger.info("Starting task %s", task)
+        with self._activity_lock:
+            self._stop_activity()
+            self._start_activity(uid, task)
+        self._start_checkpoints()
+
+    def set_time(self, value):
+        """
+        Sets the wall clock of the board. The durations are measured on the
+        monotonic clock and are not affected, the jump of the clock is
+        recorded and the start of the running activity moves along with it.
+        :param value: the epoch, or a date string from a former server
+        :return:
+        """
+        logger.info(f"setting time to {value}")
+        offset = time.time() - time.monotonic()
+        subprocess.call(["sudo", "date", "-s", date_argument(value)])
+        self._clock_changed(offset)
+
+    def _clock_changed(self, offset: float):
+        """
+        :param offset: the offset of the wall clock to the monotonic clock
+        before the change
+        :return:
+        """
+        jump = round(time.time() - time.monotonic() - offset)
+        if jump == 0:
+            return
+        logger.info(f"clock moved by {jump} s")
+        # the journal is written once recovered, the jump is recorded after
+        # its generation
+        self._wait_history()
+        with self._activity_lock:
+            if self.activity_running:
+                self._activity.set_start(self._activity.get_start() + jump)
+            self._journal.clock(jump)
+
+    def _start_activity(self, uid: list, task: str):
         self._last_id = uid
-        self._tic_task = time.time()
-        self._update_time_thread = threading.Thread(
-            target=self.update_activity_time)
-        self._update_time_thread.start()
+        self._tic_task = time.monotonic()
+        start = int(time.time())
+        self._activity.append(task, start)
+        self._journal.start(task, start)
+        self._running = True
+        if "first tag" not in self.startup_report:
+            self.startup_report["first tag"] = time.monotonic() - self._boot
+            logger.info(f"startup report (s): {self.startup_report}")
 
-    def update_activity_time(self):
+    def _update_duration(self):
         """
-        update the activity with a ping of 1s
+        Computes the duration of the running activity, in memory only
         :return:
         """
-        self.is_updating = True
-        while self.is_updating:
-            logger.debug(
-                f"update time of {self._lookup_table.get(str(self._last_id))}"
-            )
-            self._activity_table[-1] = int(time.time() - self._tic_task)
-            with open(ACTIVITY_TABLE, 'wb') as f:
-                pickle.dump(self.data, f)
-            time.sleep(1)
-        logger.info("Updating stopped")
+        if self._running:
+            self._activity.set_duration(self._elapsed())
+
+    def _elapsed(self) -> int:
+        """
+        :return: the duration of the running activity, in seconds
+        """
+        return int(time.monotonic() - self._tic_task)
+
+    def _end_activity(self):
+        self._running = False
+        self._activity.set_duration(self._elapsed())
+        self._journal.stop(self._activity.get_duration())
+        if self._journal.needs_compaction:
+            self._journal.compact(self._activity)
+
+    def _stop_activity(self):
+        if self._running:
+            self._end_activity()
+            logger.info("Updating stopped")
 
     def stop_updating(self):
-        self.is_updating = False
-        if self._update_time_thread is not None \
-                and self._update_time_thread.is_alive():
-            self._update_time_thread.join()
+        """
+        Stops the running activity, if any
+        :return:
+        """
+        with self._activity_lock:
+            self._stop_activity()
+
+    def _checkpoint(self):
+        """
+        Writes the duration of the running activity to disk, a power loss
+        then loses at most CHECKPOINT_EVERY seconds of it
+        :return:
+        """
+        logger.debug("checkpoint of %s", self._last_id)
+        self._activity.set_duration(self._elapsed())
+        self._journal.heartbeat(self._activity.get_duration())
+        self._journal.sync()
+
+    def _start_checkpoints(self):
+        if CHECKPOINT_EVERY is None or self._checkpoint_thread is not None:
+            return
+        self._checkpoint_thread = threading.Thread(
+            target=self._checkpoints, name="checkpoint", daemon=True
+        )
+        self._checkpoint_thread.start()
+
+    def _checkpoints(self):
+        while not self._closing.wait(CHECKPOINT_EVERY):
+            with self._activity_lock:
+                if self._running:
+                    self._checkpoint()
 
     def __del__(self):
+        self._closing.set()
         if self.channel is not None and self.channel.ready:
             self.channel.cleanup()
+        if self._journal is not None:
+            self._journal.close()
         self.rc522.cleanup()
 
 
 if __name__ == '__main__':
+    # kill -USR1 <pid> writes the metrics in metrics.json. The handler runs
+    # on the main thread, which may hold the lock of the metrics: the dump
+    # is left to another thread.
+    signal.signal(
+        signal.SIGUSR1,
+        lambda signum, frame: threading.Thread(
+            target=metrics.dump, name="metrics dump", daemon=True
+        ).start()
+    )
     try:
         client = Client()
-        client.run()
+        if PROFILE_FILE:
+            profiled(client.run, PROFILE_FILE)
+        else:
+            client.run()
     except Exception as e:
         logger.exception(e)
     finally:
+        metrics.dump()
         logger.info("stopping device")
@@ -0,0 +1,389 @@
+import io
+import pickle
+import struct
+import sys
+from array import array
+
+from activity_store import ActivityStore
+
+_TAG = struct.Struct('<B')
+_LENGTH = struct.Struct('<L')
+_INT8 = struct.Struct('<b')
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+_DATA = struct.Struct('<LL')  # start and cursor of a download
+_RESUME = struct.Struct('<LL')  # request id and chunks already received
+
+# tags of the tagged values of the binary codec, also the kinds of the
+# values of the schemas
+_NONE = 0x00
+_FALSE = 0x01
+_TRUE = 0x02
+_INT8_TAG = 0x03
+_INT32_TAG = 0x04
+_INT64_TAG = 0x05
+_FLOAT_TAG = 0x06
+_STR = 0x07
+_BYTES = 0x08
+_LIST = 0x09
+_TUPLE = 0x0A
+_DICT = 0x0B
+_ACTIVITY_STORE = 0x10
+
+_BUFFER_SIZE = 0x10000
+
+# messages of the hand check, which negotiates the codec: always pickled
+HANDSHAKE = ("checkhand info", "checkhand reply")
+
+
+class Codec:
+    """
+    Serialization of the values sent over the channel. A codec writes to and
+    reads from file-like objects, so a value can be streamed. The name of
+    the message tells the codec the schema of its value.
+    """
+    name = None
+    id = None
+
+    def dump(self, name: str, value, f):
+        raise NotImplementedError
+
+    def load(self, name: str, f):
+        raise NotImplementedError
+
+    def dumps(self, name: str, value) -> bytes:
+        f = io.BytesIO()
+        self.dump(name, value, f)
+        return f.getvalue()
+
+    def loads(self, name: str, x: bytes):
+        return self.load(name, io.BytesIO(x))
+
+
+class PickleCodec(Codec):
+    name = "pickle"
+    id = 0
+
+    def dump(self, name, value, f):
+        pickle.dump(value, f)
+
+    def load(self, name, f):
+        return pickle.load(f)
+
+    def dumps(self, name, value) -> bytes:
+        return pickle.dumps(value)
+
+    def loads(self, name, x: bytes):
+        return pickle.loads(x)
+
+
+def _little_endian(column: array):
+    if sys.byteorder != 'little':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return memoryview(column).cast('B')
+
+
+class BinaryCodec(Codec):
+    """
+    Compact binary encoding with a fixed schema per message: the commands,
+    the downloads and the resumptions are written as their bare fields, the
+    activity records as raw little-endian columns. The values of the other
+    messages, such as the reports of "stats" and "enrollment", are tagged
+    values: None, booleans, 64 bits integers, floats, strings, bytes, lists,
+    tuples, dicts and activity stores, anything else is sent as its repr.
+    """
+    name = "binary"
+    id = 1
+
+    def __init__(self):
+        self._tagged = (self._encode, self._decode)
+        none = (self._encode_none, self._decode_none)
+        # message name: (encode, decode) of its value
+        self._schemas = {
+            "read": none,
+            "disconnect": none,
+            "resume failed": none,
+            "write": (self._encode_str, self._decode_str),
+            "error": (self._encode_str, self._decode_str),
+            "stop": (self._encode_optional_str, self._decode_optional_str),
+            "set_time": (self._encode_int64, self._decode_int64),
+            "enroll": (self._encode_strs, self._decode_strs),
+            "send": (self._encode_cursor, self._decode_cursor),
+            "data": (self._encode_data, self._decode_data),
+            "batch": (self._encode_batch, self._decode_batch),
+            "resume": (self._encode_resume, self._decode_resume),
+        }
+
+    def dump(self, name, value, f):
+        out = bytearray()
+        encode, _ = self._schemas.get(name, self._tagged)
+        encode(value, out, f)
+        f.write(out)
+
+    def load(self, name, f):
+        _, decode = self._schemas.get(name, self._tagged)
+        return decode(f)
+
+    @staticmethod
+    def _read(f, n):
+        x = f.read(n)
+        if len(x) < n:
+            raise EOFError("binary value truncated")
+        return x
+
+    # schemas
+
+    @staticmethod
+    def _encode_none(value, out: bytearray, f):
+        if value is not None:
+            raise TypeError(f"no value expected, got {value!r}")
+
+    @staticmethod
+    def _decode_none(f):
+        return None
+
+    @staticmethod
+    def _encode_str(value: str, out: bytearray, f):
+        x = value.encode()
+        out += _LENGTH.pack(len(x))
+        out += x
+
+    def _decode_str(self, f) -> str:
+        n, = _LENGTH.unpack(self._read(f, _LENGTH.size))
+        return self._read(f, n).decode()
+
+    def _encode_optional_str(self, value, out: bytearray, f):
+        if value is None:
+            out += _TAG.pack(_NONE)
+        else:
+            out += _TAG.pack(_STR)
+            self._encode_str(value, out, f)
+
+    def _decode_optional_str(self, f):
+        tag, = self._read(f, 1)
+        return None if tag == _NONE else self._decode_str(f)
+
+    @staticmethod
+    def _encode_int64(value: int, out: bytearray, f):
+        out += _INT64.pack(value)
+
+    def _decode_int64(self, f) -> int:
+        return _INT64.unpack(self._read(f, _INT64.size))[0]
+
+    def _encode_strs(self, value, out: bytearray, f):
+        out += _LENGTH.pack(len(value))
+        for v in value:
+            self._encode_str(v, out, f)
+
+    def _decode_strs(self, f) -> list:
+        n, = _LENGTH.unpack(self._read(f, _LENGTH.size))
+        return [self._decode_str(f) for _ in range(n)]
+
+    def _encode_cursor(self, value, out: bytearray, f):
+        # nothing, a bare cursor or a cursor with its history
+        if value is None:
+            out += _TAG.pack(_NONE)
+        elif isinstance(value, dict):
+            out += _TAG.pack(_DICT) + _LENGTH.pack(value["cursor"])
+            self._encode_optional_str(value.get("history"), out, f)
+        else:
+            out += _TAG.pack(_INT32_TAG) + _LENGTH.pack(value)
+
+    def _decode_cursor(self, f):
+        tag, = self._read(f, 1)
+        if tag == _NONE:
+            return None
+        cursor, = _LENGTH.unpack(self._read(f, _LENGTH.size))
+        if tag == _DICT:
+            return {
+                "cursor": cursor, "history": self._decode_optional_str(f)
+            }
+        return cursor
+
+    def _encode_store(self, value: ActivityStore, out: bytearray, f):
+        task_names, task_ids, starts, durations = value.columns()
+        self._encode_strs(task_names, out, f)
+        out += _LENGTH.pack(len(starts))
+        f.write(out)
+        out.clear()
+        for column in (task_ids, starts, durations):
+            f.write(_little_endian(column))
+
+    def _decode_store(self, f) -> ActivityStore:
+        task_names = self._decode_strs(f)
+        n, = _LENGTH.unpack(self._read(f, _LENGTH.size))
+        columns = []
+        for typecode in ('I', 'q', 'I'):
+            column = array(typecode)
+            column.frombytes(self._read(f, n * column.itemsize))
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+        return ActivityStore.from_columns(task_names, *columns)
+
+    def _encode_data(self, value: dict, out: bytearray, f):
+        out += _DATA.pack(value["start"], value["cursor"])
+        self._encode_optional_str(value.get("history"), out, f)
+        self._encode_store(value["records"], out, f)
+
+    def _decode_data(self, f) -> dict:
+        start, cursor = _DATA.unpack(self._read(f, _DATA.size))
+        history = self._decode_optional_str(f)
+        return {
+            "start": start,
+            "cursor": cursor,
+            "records": self._decode_store(f),
+            "history": history,
+        }
+
+    def _encode_message(self, value, out: bytearray, f):
+        # a (name, value) pair, the value with the schema of the name
+        name, argument = value
+        self._encode_str(name, out, f)
+        encode, _ = self._schemas.get(name, self._tagged)
+        encode(argument, out, f)
+
+    def _decode_message(self, f) -> tuple:
+        name = self._decode_str(f)
+        _, decode = self._schemas.get(name, self._tagged)
+        return name, decode(f)
+
+    def _encode_batch(self, value, out: bytearray, f):
+        # the commands of a batch, or their replies, None without reply
+        out += _LENGTH.pack(len(value))
+        for message in value:
+            if message is None:
+                out += _TAG.pack(_NONE)
+            else:
+                out += _TAG.pack(_TUPLE)
+                self._encode_message(message, out, f)
+
+    def _decode_batch(self, f) -> list:
+        n, = _LENGTH.unpack(self._read(f, _LENGTH.size))
+        messages = []
+        for _ in range(n):
+            tag, = self._read(f, 1)
+            messages.append(None if tag == _NONE else self._decode_message(f))
+        return messages
+
+    def _encode_resume(self, value: dict, out: bytearray, f):
+        out += _RESUME.pack(value["request_id"], value["chunks"])
+        self._encode_message(value["command"], out, f)
+
+    def _decode_resume(self, f) -> dict:
+        request_id, chunks = _RESUME.unpack(self._read(f, _RESUME.size))
+        return {
+            "request_id": request_id,
+            "chunks": chunks,
+            "command": self._decode_message(f),
+        }
+
+    # tagged values
+
+    def _encode(self, value, out: bytearray, f):
+        if len(out) >= _BUFFER_SIZE:
+            f.write(out)
+            out.clear()
+        if value is None:
+            out += _TAG.pack(_NONE)
+        elif value is True:
+            out += _TAG.pack(_TRUE)
+        elif value is False:
+            out += _TAG.pack(_FALSE)
+        elif isinstance(value, int) \
+                and -0x8000000000000000 <= value <= 0x7fffffffffffffff:
+            if -0x80 <= value <= 0x7f:
+                out += _TAG.pack(_INT8_TAG) + _INT8.pack(value)
+            elif -0x80000000 <= value <= 0x7fffffff:
+                out += _TAG.pack(_INT32_TAG) + _INT32.pack(value)
+            else:
+                out += _TAG.pack(_INT64_TAG) + _INT64.pack(value)
+        elif isinstance(value, float):
+            out += _TAG.pack(_FLOAT_TAG) + _FLOAT.pack(value)
+        elif isinstance(value, str):
+            out += _TAG.pack(_STR)
+            self._encode_str(value, out, f)
+        elif isinstance(value, bytes):
+            out += _TAG.pack(_BYTES) + _LENGTH.pack(len(value)) + value
+        elif isinstance(value, (list, tuple)):
+            tag = _LIST if isinstance(value, list) else _TUPLE
+            out += _TAG.pack(tag) + _LENGTH.pack(len(value))
+            for v in value:
+                self._encode(v, out, f)
+        elif isinstance(value, dict):
+            out += _TAG.pack(_DICT) + _LENGTH.pack(len(value))
+            for k, v in value.items():
+                self._encode(k, out, f)
+                self._encode(v, out, f)
+        elif isinstance(value, ActivityStore):
+            out += _TAG.pack(_ACTIVITY_STORE)
+            self._encode_store(value, out, f)
+        else:
+            # a report is sent whatever it holds, as json.dump(default=repr)
+            self._encode(repr(value), out, f)
+
+    def _decode(self, f):
+        tag, = self._read(f, 1)
+        if tag == _NONE:
+            return None
+        if tag == _TRUE:
+            return True
+        if tag == _FALSE:
+            return False
+        if tag == _INT8_TAG:
+            return _INT8.unpack(self._read(f, 1))[0]
+        if tag == _INT32_TAG:
+            return _INT32.unpack(self._read(f, 4))[0]
+        if tag == _INT64_TAG:
+            return _INT64.unpack(self._read(f, 8))[0]
+        if tag == _FLOAT_TAG:
+            return _FLOAT.unpack(self._read(f, 8))[0]
+        if tag == _STR:
+            return self._decode_str(f)
+        if tag == _ACTIVITY_STORE:
+            return self._decode_store(f)
+        if tag in (_BYTES, _LIST, _TUPLE, _DICT):
+            n, = _LENGTH.unpack(self._read(f, 4))
+            if tag == _BYTES:
+                return self._read(f, n)
+            if tag == _LIST:
+                return [self._decode(f) for _ in range(n)]
+            if tag == _TUPLE:
+                return tuple(self._decode(f) for _ in range(n))
+            return {self._decode(f): self._decode(f) for _ in range(n)}
+        raise ValueError(f"unknown binary tag {tag}")
+
+
+# name: codec, the order is the order of preference. Pickle is only the
+# fallback for a peer without the binary codec, and the codec of the hand
+# check.
+CODECS = {
+    codec.name: codec for codec in (BinaryCodec(), PickleCodec())
+}
+
+
+def negotiate_codec(offered):
+    """
+    Picks the preferred codec among the ones offered by the other side
+    :param offered: the names of the codecs of the other side
+    :return: the name of the codec, "pickle" if nothing matches
+    """
+    for name in CODECS:
+        if name in offered:
+            return name
+    return "pickle"
+
+
+def codec_for(negotiated, name: str) -> Codec:
+    """
+    :param negotiated: the name of the negotiated codec, None before
+    negotiation
+    :param name: the name of the message
+    :return: the codec of the message, every message but the hand check
+    uses the negotiated codec
+    """
+    if negotiated is None or name in HANDSHAKE:
+        return CODECS["pickle"]
+    return CODECS[negotiated]
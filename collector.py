@@ -0,0 +1,174 @@
+#  Headless collector: pulls the activities of every board at once, one
+#  board per desk, and merges them in one store.
+#  usage: python collector.py [transport url ...], by default every paired
+#  board found by Bluetooth
+
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from activity_store import ActivityStore, download_cursor, merge_download
+from analytics import AnalyticsStore
+from bluetooth_manager import PCBluetoothManager
+from communication import CommandFailed, CommunicationChannel
+from logger import logger
+from transport import RfcommTransport, transport_from_url
+
+COLLECTOR_STORE = "collector.pkl"
+# BlueZ handles few simultaneous RFCOMM connections per adapter
+MAX_WORKERS = 4
+
+
+class Collector:
+    """
+    Downloads the activities of several boards concurrently, with a bounded
+    pool of workers. Each board has its own mirror and cursor, so only the
+    activities recorded since the last collect are sent. A worker only
+    touches the mirror of its board, the mirrors are merged once all the
+    boards are done. The downloads also go to the analytics store, from the
+    thread of the collect since an SQLite connection stays in its thread.
+    """
+
+    def __init__(self, boards: dict, path=COLLECTOR_STORE,
+                 max_workers=MAX_WORKERS, analytics=None):
+        """
+        :param boards: the transport of each board, by board name
+        :param path: the file of the mirrors, a store and the cursor of the
+        next download by board name
+        :param max_workers: the maximum number of boards downloaded at once
+        :param analytics: the AnalyticsStore to merge the downloads in, None
+        for none
+        """
+        self.boards = boards
+        self.path = path
+        self.max_workers = max_workers
+        self.analytics = analytics
+        self.mirrors = self._load()
+        self.report = dict()
+        self._downloads = dict()
+
+    def _load(self) -> dict:
+        if not os.path.isfile(self.path):
+            return dict()
+        with open(self.path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.mirrors, f)
+        os.replace(tmp_path, self.path)
+
+    def collect(self) -> dict:
+        """
+        Downloads every board and saves the mirrors
+        :return: the report of each board, by board name
+        """
+        for name in self.boards:
+            self.mirrors.setdefault(
+                name, {"store": ActivityStore(), "cursor": 0}
+            )
+        tic = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            reports = executor.map(self._collect_board, self.boards)
+            self.report = dict(zip(self.boards, reports))
+        self.save()
+        if self.analytics is not None:
+            for name, (start, records) in self._downloads.items():
+                self.analytics.merge(start, records, name)
+        self._downloads.clear()
+        logger.info(
+            f"{len(self.boards)} boards collected in "
+            f"{time.perf_counter() - tic:.2f} s"
+        )
+        return self.report
+
+    def _collect_board(self, name: str) -> dict:
+        """
+        Downloads the activities of a board since its cursor
+        :param name: the name of the board
+        :return: the status of the board and the time of each step
+        """
+        mirror = self.mirrors[name]
+        report = {"status": "ok", "records": 0}
+        channel = CommunicationChannel(transport=self.boards[name])
+        tic = time.perf_counter()
+        try:
+            channel.check_hand()
+            report["connect"] = time.perf_counter() - tic
+            tic = time.perf_counter()
+            batch = channel.batch()
+            batch.command("set_time", int(time.time()))
+            send = batch.command("send", download_cursor(mirror))
+            reply, data = batch.flush()[send]
+            if reply == "error":
+                raise CommandFailed(data)
+            report["download"] = time.perf_counter() - tic
+            tic = time.perf_counter()
+            start = merge_download(mirror, data)
+            self._downloads[name] = (start, data["records"])
+            report["merge"] = time.perf_counter() - tic
+            report["records"] = len(data["records"])
+        except Exception as err:
+            logger.warning(f"Collect of {name} failed")
+            logger.exception(err)
+            report["status"] = f"failed: {err!r}"
+        finally:
+            if not channel.is_closed:
+                channel.disconnect()
+        return report
+
+    def merged(self) -> ActivityStore:
+        """
+        :return: the activities of all the boards in one store, by start time
+        """
+        activities = sorted(
+            (activity for mirror in self.mirrors.values()
+             for activity in mirror["store"]),
+            key=lambda activity: activity[1]
+        )
+        store = ActivityStore()
+        for task, start, duration in activities:
+            store.append(task, start, duration)
+        return store
+
+
+def discover_boards() -> dict:
+    """
+    :return: the RFCOMM transport of each paired board, by board name
+    """
+    return {
+        name: RfcommTransport(mac=mac)
+        for name, mac in PCBluetoothManager().get_mac_addresses().items()
+    }
+
+
+def print_report(report: dict):
+    for name, board in report.items():
+        timings = ", ".join(
+            f"{step} {board[step] * 1e3:.1f} ms"
+            for step in ("connect", "download", "merge") if step in board
+        )
+        print(
+            f"{name}: {board['status']}, {board['records']} activities"
+            + (f" ({timings})" if timings else "")
+        )
+
+
+def run(urls=()):
+    if urls:
+        boards = {url: transport_from_url(url) for url in urls}
+    else:
+        boards = discover_boards()
+    if not boards:
+        logger.warning("No board found")
+        return
+    collector = Collector(boards, analytics=AnalyticsStore())
+    print_report(collector.collect())
+    logger.info(f"{len(collector.merged())} activities collected")
+
+
+if __name__ == '__main__':
+    run(sys.argv[1:])
@@ -1,13 +1,18 @@
+import itertools
+import secrets
+import threading
 import time
-import pickle
 import socket
-import struct
+from collections import OrderedDict
 
+from codec import CODECS, negotiate_codec
+from framing import COMPRESSIONS, CountingWriter, SocketReader, \
+    negotiate_compression, read_message, write_message
 from logger import logger
+from metrics import metrics
+from transport import RfcommTransport
 from bluetooth_manager import PCBluetoothManager, BoardBluetoothManager
 
-_BT_PORT = 4
-
 
 class BaseChannel:
 
@@ -16,32 +21,63 @@ class BaseChannel:
         self.is_PC = False
         self.connected = False
 
-    def _send_object(self, name, value):
+    def _send_object(self, name, value, request_id=None):
+        raise NotImplementedError
+
+    def _read_object(self, wait=True, request_id=None):
         raise NotImplementedError
 
-    def _read_object(self, wait=True):
+    def _read_request(self):
         raise NotImplementedError
 
-    def send_sensor(self, name, value):
+    def send_sensor(self, name, value, request_id=None):
         if self.is_PC:
             raise Exception('PC cannot send sensor data')
-        self._send_object(name, value)
+        return self._send_object(
+            name, value, request_id=request_id, stream=True
+        )
 
     def send_command(self, name, value=None):
+        """
+        :return: the request id of the command, to read its reply
+        """
         if not self.is_PC:
             raise Exception('Robot cannot send motor data')
         return self._send_object(name, value)
 
-    def read_sensor(self, wait=True) -> str:
+    def read_sensor(self, wait=True, request_id=None) -> str:
+        """
+        :param wait: wait for the reply, return None if there is none yet
+        :param request_id: the request id of the command to read the reply
+        of, None to read the oldest reply
+        """
         if not self.is_PC:
             raise Exception('Robot cannot read sensor data')
-        return self._read_object(wait)
+        return self._read_object(wait, request_id)
+
+    def request(self, name, value=None):
+        """
+        Sends a command and waits for its own reply, other commands can be
+        pending on the channel at the same time
+        :return: the reply (name, value)
+        """
+        request_id = self.send_command(name, value)
+        return self.read_sensor(request_id=request_id)
 
     def read_command(self):
         if self.is_PC:
             raise Exception('PC cannot read motor data')
         return self._read_object()
 
+    def read_request(self):
+        """
+        Same as read_command, along with the request id to reply to
+        :return: (request id, name, value)
+        """
+        if self.is_PC:
+            raise Exception('PC cannot read motor data')
+        return self._read_request()
+
     def scan_bluetooth_devices(self):
         logger.info("default (fake) Bluetooth scan")
         addr_list = ['AA:AA:AA:AA:AA:AA', 'BB:BB:BB:BB:BB:BB']
@@ -49,37 +85,159 @@ class BaseChannel:
 
 
 TIMEOUT_READ = 15
+# delay before reconnecting after the connection is lost, doubled after each
+# failed attempt
+RECONNECT_DELAY = .5  # s
+RECONNECT_MAX_DELAY = 8  # s
+RECONNECT_ATTEMPTS = 10  # on the PC, 0 not to reconnect
+RESUMABLE_STREAMS = 4  # replies in chunks the board can send again
+MAX_RESUMES = 3  # times a request is sent again before giving up on it
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class CommandFailed(Exception):
+    """
+    The board could not run the command, its "error" reply carries the
+    reason
+    """
+
+
+def backoff_delays(delay=RECONNECT_DELAY, max_delay=RECONNECT_MAX_DELAY):
+    """
+    :return: the delays between connection attempts, doubled each time up to
+    max_delay
+    """
+    while True:
+        yield delay
+        delay = min(2 * delay, max_delay)
+
+
+class CommandBatch:
+    """
+    Commands queued to be sent in one message, the board runs them in order
+    and sends all their replies in one message: a single round trip instead
+    of one per command. See CommunicationChannel.batch.
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+        self.commands = []
+
+    def command(self, name, value=None) -> int:
+        """
+        Queues a command
+        :return: the index of its reply in the replies of flush
+        """
+        self.commands.append((name, value))
+        return len(self.commands) - 1
+
+    def flush(self, progress=None) -> list:
+        """
+        Sends the queued commands and waits for their replies
+        :param progress: see CommunicationChannel.request
+        :return: the replies (name, value) in the order of the commands,
+        None for a command without reply, ("error", reason) for a command
+        that failed on the board
+        """
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+        _, replies = self._channel.request("batch", commands, progress)
+        return replies
+
+    def __len__(self):
+        return len(self.commands)
 
 
 class CommunicationChannel(BaseChannel):
-
-    def __init__(self, side='PC'):
+    """
+    Channel over one socket, RFCOMM unless another transport is given. Each
+    message carries a request id, the board replies with the request id of
+    the command. On the PC a receiving thread dispatches the replies to the
+    threads waiting for them, so several commands can be pending at the same
+    time.
+
+    Each side has a session id, exchanged at the hand check. When the
+    connection is lost, the PC connects again with a backoff and, if the
+    board still has the same session, the pending requests are resumed: a
+    reply sent in chunks restarts from the first chunk not received, the
+    board keeping its last RESUMABLE_STREAMS replies in chunks.
+    """
+
+    def __init__(self, side='PC', bluetooth_manager=None, transport=None):
+        """
+        :param side: 'PC' or 'Board'
+        :param bluetooth_manager: the Bluetooth manager of the side, by
+        default the one of the real device when RFCOMM is used
+        :param transport: the transport of the sockets, by default RFCOMM
+        with the MAC address of the Bluetooth manager
+        """
         super(CommunicationChannel, self).__init__()
 
         # are we on the PC or robot side?
         self.side = side
         self.is_PC = side == 'PC'
+        if transport is None and bluetooth_manager is None:
+            bluetooth_manager = PCBluetoothManager() if self.is_PC \
+                else BoardBluetoothManager()
         if self.is_PC:
-            self.pc_bluetooth_manager = PCBluetoothManager()
+            self.pc_bluetooth_manager = bluetooth_manager
         else:
-            self.board_bluetooth_manager = BoardBluetoothManager()
+            self.board_bluetooth_manager = bluetooth_manager
+        self.transport = transport or RfcommTransport(bluetooth_manager)
         self._connection = None
         self._socket = None
         self._file = None
-        self.send_lock = self.read_lock = self.check_hand_lock = False
+        self._reader = None
+        self.send_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.check_hand_lock = threading.Lock()
         self.first_no_data_time = None
         self.ready = False
+        # compression of the streamed values and codec of all the values,
+        # None until negotiated
+        self.compression = None
+        self.codec = None
+        # request ids and replies not read yet, by request id
+        self._request_ids = itertools.count(1)
+        self._replies = OrderedDict()
+        self._replies_condition = threading.Condition()
+        self._receive_thread = None
+        # progress callbacks of the pending requests and cancelled requests,
+        # by request id
+        self._progress = dict()
+        self._cancelled = set()
+        self._received_at = time.monotonic()  # time of the last chunk
+        # sessions of both sides, the one of the other side is None until
+        # the first hand check
+        self.session = secrets.token_hex(8)
+        self.peer_session = None
+        self.resumed = False  # same session as before the last hand check
+        self.reconnect_attempts = RECONNECT_ATTEMPTS if self.is_PC else 0
+        self._reconnecting = False
+        # PC: called without argument from the receiving thread when the
+        # connection is lost for good
+        self.on_lost = None
+        # PC: commands of the pending requests and compressed chunks of
+        # their replies received so far, by request id
+        self._pending = dict()
+        self._partial = dict()
+        self._resumes = dict()  # times each request was sent again
+        # board: the last replies sent in chunks, by request id
+        self._streams = OrderedDict()
 
     def check_hand(self):
         self.ready = True
 
         # lock system
-        if self.check_hand_lock:
+        if not self.check_hand_lock.acquire(blocking=False):
             raise ConnectionError('channel already busy checking hand')
         logger.debug('channel - handcheck lock')
-
-        mem_read_lock = self.read_lock
-        self.check_hand_lock = self.read_lock = self.send_lock = True
+        self.send_lock.acquire()
+        self.read_lock.acquire()
 
         # connect and handle connection errors
         try:
@@ -88,51 +246,40 @@ class CommunicationChannel(BaseChannel):
             # robot, because only the robot has a fix IP address...
             if self.is_PC:
                 # sensor stream
-                # we check the protocol to create the right socket+
                 self._connection = None
-                b_mac = self.pc_bluetooth_manager.get_mac_address()
-                _socket = socket.socket(
-                    socket.AF_BLUETOOTH,
-                    socket.SOCK_STREAM,
-                    socket.BTPROTO_RFCOMM
-                )
-
-                sensor_address = (b_mac, _BT_PORT)
-                _socket.settimeout(TIMEOUT_READ)
-                _socket.setsockopt(
-                    socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
-                )
-                try:
-                    _socket.connect(sensor_address)
-                    logger.info(' [connected]')
-                except Exception as err:
-                    _socket.close()
-                    logger.warning(' [failed]')
-                    logger.exception(err)
-                    raise ConnectionRefusedError
+                _socket = self._connect()
                 self._connection = _socket
-                self._file = _socket.makefile('rwb')
+                self._file = CountingWriter(_socket.makefile('wb'))
+                self._reader = SocketReader(_socket)
 
                 # motor stream
                 time.sleep(.2)  # make sure the board has time to listen for
                 # the second socket connection
                 name, info = self._read_object(ignore_lock=True)
-                # do stuff with name info
-            else:
-                _socket = socket.socket(
-                    socket.AF_BLUETOOTH,
-                    socket.SOCK_STREAM,
-                    socket.BTPROTO_RFCOMM
+                self._set_peer_session(info.get("session"))
+                self.compression = negotiate_compression(
+                    info.get("compression", ())
                 )
-                _socket.bind(
-                    (self.board_bluetooth_manager.mac, _BT_PORT)
+                self.codec = negotiate_codec(info.get("codecs", ()))
+                self._send_object(
+                    'checkhand reply', {
+                        "compression": self.compression,
+                        "codec": self.codec,
+                        "session": self.session,
+                    },
+                    ignore_lock=True
                 )
-
-                _socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                _socket.listen(1)
-                self._connection, _ = _socket.accept()
-                _socket.close()
-                self._file = self._connection.makefile('rwb')
+                logger.info(
+                    f' [compression: {self.compression}, codec: {self.codec}]'
+                )
+                self._receive_thread = threading.Thread(
+                    target=self._receive, daemon=True
+                )
+                self._receive_thread.start()
+            else:
+                self._connection = self._accept()
+                self._file = CountingWriter(self._connection.makefile('wb'))
+                self._reader = SocketReader(self._connection)
                 logger.info(' [accepted connection]')
 
                 # motor stream
@@ -140,25 +287,65 @@ class CommunicationChannel(BaseChannel):
                 # send info
                 info = {
                     "task": "time",
+                    "compression": list(COMPRESSIONS),
+                    "codecs": list(CODECS),
+                    "session": self.session,
                 }
                 self._send_object('checkhand info', info, ignore_lock=True)
                 logger.info(' [sent checkhand info]')
+                name, reply = self._read_object(ignore_lock=True)
+                self._set_peer_session(reply.get("session"))
+                if not self.resumed:
+                    self._streams.clear()
+                self.compression = reply["compression"]
+                self.codec = reply.get("codec", None)
+                logger.info(
+                    f' [compression: {self.compression}, codec: {self.codec}]'
+                )
             self.connected = True
 
         except Exception as err:
-            # connection failed, cleanup sockets before raising error again
-            self.cleanup()
+            # connection failed, cleanup sockets before raising error again,
+            # the replies already received are kept while reconnecting
+            if self._reconnecting:
+                self._close()
+            else:
+                self.cleanup()
             raise err
 
         finally:
             logger.debug('channel - handcheck unlock')
-            self.check_hand_lock = self.send_lock = False
-            self.read_lock = mem_read_lock
+            self.read_lock.release()
+            self.send_lock.release()
+            self.check_hand_lock.release()
         logger.info(' [done]')
         logger.debug('[channel connected]')
 
+    def _set_peer_session(self, session):
+        self.resumed = session is not None and session == self.peer_session
+        self.peer_session = session
+        logger.info(
+            f' [session: {session}{" resumed" if self.resumed else ""}]'
+        )
+
+    def _connect(self) -> socket.socket:
+        """
+        PC side: connects to the board
+        :return: the connected socket
+        """
+        return self.transport.connect(TIMEOUT_READ)
+
+    def _accept(self) -> socket.socket:
+        """
+        Board side: waits for the PC to connect
+        :return: the accepted socket
+        """
+        return self.transport.accept()
+
     def disconnect(self):
         if self.connected:
+            # the board closing the connection is then not seen as a loss
+            self.connected = False
             try:
                 self.send_command('disconnect')
             except Exception as e:
@@ -168,6 +355,17 @@ class CommunicationChannel(BaseChannel):
             logger.info("Channel already disconnected")
 
     def cleanup(self):
+        self._close()
+        with self._replies_condition:
+            self._replies.clear()
+            self._cancelled.clear()
+            self._replies_condition.notify_all()
+
+    def _close(self):
+        """
+        Closes the sockets, the replies not read yet are kept
+        :return:
+        """
         logger.info(
             'Cleaning up communication channel ({} side)'.format(self.side)
         )
@@ -194,31 +392,49 @@ class CommunicationChannel(BaseChannel):
         else:
             return True
 
-    def _send_object(self, name: str, value=None, ignore_lock=False):
+    def _send_object(self, name: str, value=None, ignore_lock=False,
+                     stream=False, request_id=None, skip=0):
+        """
+        :param ignore_lock: the caller already holds the send lock
+        :param stream: send the value as compressed chunks
+        :param request_id: the request id to reply to, None for a new request
+        :param skip: the number of first chunks not to send
+        :return: the request id of the message
+        """
+        if request_id is None:
+            request_id = next(self._request_ids)
+        if stream and not self.is_PC:
+            # kept to be sent again if the connection is lost meanwhile
+            self._streams[request_id] = (name, value)
+            self._streams.move_to_end(request_id)
+            while len(self._streams) > RESUMABLE_STREAMS:
+                self._streams.popitem(last=False)
         # lock system
-        while not ignore_lock and self.send_lock:
-            logger.warning('channel already busy sending data, wait')
-            logger.debug('channel - sending locked, waiting')
-            time.sleep(.1)
-        logger.debug('channel - send lock (%s)' % name)
-        self.send_lock = True
+        if not ignore_lock:
+            if self.send_lock.locked():
+                logger.debug('channel - sending locked, waiting')
+            tic = time.perf_counter()
+            self.send_lock.acquire()
+            metrics.observe(
+                "channel.send_lock_wait", time.perf_counter() - tic
+            )
+        logger.debug('channel - send lock (%s)', name)
 
         # select channel
         f = self._file
 
         # send and handle connection errors
         try:
-            # name
-            x = str.encode(name)
-            f.write(struct.pack('<H', len(x)))
-            f.write(x)
-
-            # value
-            x = pickle.dumps(value)
-            f.write(struct.pack('<L', len(x)))
-            f.write(x)
+            if f is None:  # closed, or the reconnection gave up
+                raise ConnectionAbortedError(f"not connected to send {name}")
+            written = f.written
+            write_message(
+                f, request_id, name, value, self.codec,
+                self.compression if stream else None, skip
+            )
             f.flush()
-            return
+            metrics.count("channel.bytes_sent." + name, f.written - written)
+            return request_id
         except ConnectionResetError:
             logger.warning("Connection lost while sending object")
 
@@ -227,81 +443,362 @@ class CommunicationChannel(BaseChannel):
                 logger.debug('channel - send unlock')
                 if name == 'disconnect':
                     self.connected = False
-                self.send_lock = False
+                self.send_lock.release()
+
+    def request(self, name, value=None, progress=None):
+        """
+        Sends a command and waits for its own reply, other commands can be
+        pending on the channel at the same time
+        :param progress: called from the receiving thread with the number of
+        bytes received so far, for a reply sent in chunks
+        :return: the reply (name, value)
+        :raise CommandFailed: the board replied with an error
+        """
+        if not self.is_PC:
+            raise Exception('Robot cannot send motor data')
+        request_id = next(self._request_ids)
+        self._progress[request_id] = progress
+        self._pending[request_id] = (name, value)
+        try:
+            self._wait_reconnected()
+            try:
+                self._send_object(name, value, request_id=request_id)
+            except (OSError, AttributeError, ValueError) as err:
+                # connection lost: the command is sent again once reconnected
+                if not self.reconnect_attempts \
+                        or not (self.connected or self._reconnecting):
+                    raise
+                logger.warning(f"Sending {name} failed: {err!r}")
+            reply = self.read_sensor(request_id=request_id)
+            if reply is not None and reply[0] == "error":
+                raise CommandFailed(reply[1])
+            return reply
+        finally:
+            self._progress.pop(request_id, None)
+            self._pending.pop(request_id, None)
+            self._partial.pop(request_id, None)
+            self._resumes.pop(request_id, None)
+
+    def batch(self) -> CommandBatch:
+        """
+        :return: an empty batch of commands for this channel
+        """
+        if not self.is_PC:
+            raise Exception('Robot cannot send motor data')
+        return CommandBatch(self)
+
+    def _wait_reconnected(self):
+        with self._replies_condition:
+            while self._reconnecting:
+                self._replies_condition.wait()
+
+    def cancel(self, request_id=None):
+        """
+        Stops waiting for the reply of a request, the thread waiting for it
+        gets RequestCancelled. The reply is still received, and dropped.
+        :param request_id: the request to cancel, None for all the pending
+        ones
+        :return:
+        """
+        with self._replies_condition:
+            if request_id is None:
+                self._cancelled.update(self._progress)
+            else:
+                self._cancelled.add(request_id)
+            self._replies_condition.notify_all()
+
+    def _chunks_of(self, request_id):
+        """
+        :return: the list of the chunks of the reply to a pending request,
+        None if no request waits for it
+        """
+        if request_id not in self._pending:
+            return None
+        return self._partial.setdefault(request_id, [])
+
+    def _on_chunk(self, request_id, received):
+        self._received_at = time.monotonic()
+        progress = self._progress.get(request_id)
+        if progress is not None:
+            progress(received)
+
+    def _read_frame(self, wait=True):
+        """
+        Reads one message from the socket
+        :param wait: if False, return None when no message has started to
+        arrive
+        :return: (request id, name, value)
+        """
+        s = self._connection  # type: socket.socket
+        f = self._reader
 
-    def _read_object(self, wait=True, ignore_lock=False):
-        # lock system
-        while not ignore_lock and self.read_lock:
-            logger.warning('channel already busy reading, wait')
-            logger.debug('channel - read locked, waiting')
-            time.sleep(.1)
-        logger.debug('channel - read lock')
-        self.read_lock = True
+        # no waiting: short timeout, only for the beginning of the message
+        if not wait:
+            s.settimeout(.001)
+            try:
+                f.wait()
+            except socket.timeout:
+                return None
+            finally:
+                s.settimeout(TIMEOUT_READ)
+        consumed = f.consumed
+        message = read_message(
+            f, self._on_chunk, self._chunks_of if self.is_PC else None,
+            self.codec
+        )
+        metrics.count(
+            "channel.bytes_received." + message[1], f.consumed - consumed
+        )
+        return message
+
+    def _receive(self):
+        """
+        Receiving thread of the PC: dispatches the replies of the board until
+        the connection is closed, reconnects if it is lost
+        :return:
+        """
+        lost = False
+        while not self.is_closed:
+            try:
+                try:
+                    self._reader.wait()
+                except socket.timeout:
+                    continue  # an idle board is not an error
+                message = self._read_frame()
+            except (OSError, AttributeError) as err:
+                # AttributeError: the channel was cleaned up meanwhile, not
+                # connected: disconnecting
+                if not self.is_closed and self.connected:
+                    logger.warning(f"Connection lost while reading: {err}")
+                    lost = True
+                    self._reconnecting = self.reconnect_attempts > 0
+                    self.connected = False
+                break
+            request_id, name, value = message
+            if name == "resume failed":
+                self._restart(request_id)
+                continue
+            if name == "error" and request_id not in self._pending:
+                # a command sent without waiting for its reply
+                logger.warning(f"Command {request_id} failed: {value}")
+                continue
+            self._partial.pop(request_id, None)
+            with self._replies_condition:
+                if request_id in self._cancelled:
+                    self._cancelled.discard(request_id)
+                    continue
+                self._replies[request_id] = (name, value)
+                self._replies_condition.notify_all()
+        with self._replies_condition:
+            self._replies_condition.notify_all()
+        logger.debug("channel - receiving stopped")
+        if lost and self._reconnecting:
+            try:
+                lost = not self._reconnect()
+            finally:
+                with self._replies_condition:
+                    self._reconnecting = False
+                    self._received_at = time.monotonic()
+                    self._replies_condition.notify_all()
+        if lost and self.on_lost is not None:
+            self.on_lost()
+
+    def _reconnect(self):
+        """
+        PC side: hand checks again after the connection was lost, waiting
+        longer after each failed attempt, then resumes the pending requests
+        :return: True if connected again
+        """
+        self._close()
+        delays = backoff_delays()
+        for attempt in range(1, self.reconnect_attempts + 1):
+            time.sleep(next(delays))
+            logger.info(f"Reconnecting, attempt {attempt}")
+            try:
+                self.check_hand()
+            except OSError as err:
+                logger.warning(f"Reconnection failed: {err!r}")
+                continue
+            self._resume()
+            return True
+        logger.warning("Could not reconnect")
+        return False
+
+    def _resume(self):
+        """
+        Sends the pending requests again, each one along with the number of
+        chunks of its reply already received. A new session of the board
+        means it restarted, its replies are then downloaded from the start.
+        :return:
+        """
+        if not self.resumed:
+            self._partial.clear()
+        for request_id, command in list(self._pending.items()):
+            resumes = self._resumes.get(request_id, 0) + 1
+            if resumes > MAX_RESUMES:
+                # the connection is lost each time, the waiting thread gets
+                # CommandFailed instead of waiting forever
+                logger.warning(
+                    f"Request {request_id} {command[0]} given up after "
+                    f"{MAX_RESUMES} resumptions"
+                )
+                self._pending.pop(request_id, None)
+                with self._replies_condition:
+                    self._replies[request_id] = (
+                        "error", f"connection lost {resumes} times"
+                    )
+                    self._replies_condition.notify_all()
+                continue
+            self._resumes[request_id] = resumes
+            if self.peer_session is None:
+                # a board without session does not know "resume"
+                logger.info(f"Restarting request {request_id} {command[0]}")
+                self._send_object(*command, request_id=request_id)
+                continue
+            chunks = len(self._partial.get(request_id, ()))
+            logger.info(
+                f"Resuming request {request_id} {command[0]} from chunk "
+                f"{chunks}"
+            )
+            self._send_object("resume", {
+                "request_id": request_id,
+                "chunks": chunks,
+                "command": command,
+            })
+
+    def _restart(self, request_id):
+        """
+        The board no longer has the reply to resume, the command is sent
+        again and its reply downloaded from the start
+        :param request_id: the request id of the command
+        :return:
+        """
+        self._partial.pop(request_id, None)
+        command = self._pending.get(request_id)
+        if command is not None:
+            logger.info(f"Restarting request {request_id} {command[0]}")
+            self._send_object(*command, request_id=request_id)
+
+    def _wait_reply(self, wait=True, request_id=None):
+        with self._replies_condition:
+            deadline = time.monotonic() + TIMEOUT_READ
+            while True:
+                if request_id is None and self._replies:
+                    self.first_no_data_time = None
+                    return self._replies.popitem(last=False)[1]
+                if request_id in self._replies:
+                    self.first_no_data_time = None
+                    self._cancelled.discard(request_id)
+                    return self._replies.pop(request_id)
+                if request_id is not None and request_id in self._cancelled:
+                    raise RequestCancelled(request_id)
+                if self._reconnecting:
+                    if not wait:
+                        return None
+                    # the deadline starts again once reconnected
+                    self._replies_condition.wait()
+                    continue
+                if not self.connected or self.is_closed:
+                    raise ConnectionAbortedError
+                if not wait:
+                    # no waiting: no data yet is fine as long as the first
+                    # attempt was no longer than TIMEOUT_READ before
+                    if self.first_no_data_time is None:
+                        self.first_no_data_time = time.time()
+                    if time.time() < self.first_no_data_time + TIMEOUT_READ:
+                        return None
+                    raise socket.timeout
+                # a reply still arriving in chunks is not late
+                remaining = max(deadline, self._received_at + TIMEOUT_READ) \
+                    - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout
+                self._replies_condition.wait(remaining)
+
+    def _read_object(self, wait=True, request_id=None, ignore_lock=False):
+        message = self._read_message(wait, request_id, ignore_lock)
+        if message is None:
+            return None
+        return message[1:]
+
+    def _read_request(self):
+        """
+        Board side: reads the next command, the resumptions of the replies
+        interrupted by a lost connection are handled here
+        :return: (request id, name, value)
+        """
+        while True:
+            message = self._read_message()
+            if message is None or message[1] != "resume":
+                return message
+            message = self._resume_reply(**message[2])
+            if message is not None:
+                return message
+
+    def _resume_reply(self, request_id, chunks, command):
+        """
+        Board side: sends the chunks of a reply the PC did not receive
+        :param request_id: the request id of the interrupted command
+        :param chunks: the number of chunks the PC received
+        :param command: the name and value of the command
+        :return: the command to run if it has no reply to resume yet
+        """
+        if request_id in self._streams:
+            name, value = self._streams[request_id]
+            logger.info(
+                "resuming reply %d from chunk %d", request_id, chunks
+            )
+            self._send_object(
+                name, value, stream=True, request_id=request_id, skip=chunks
+            )
+            return None
+        if chunks:
+            # the reply was dropped, it starts over
+            self._send_object("resume failed", request_id=request_id)
+            return None
+        return (request_id, *command)
+
+    def _read_message(self, wait=True, request_id=None, ignore_lock=False):
         # if we are aware that we are not connected
-        if not self.connected and not ignore_lock:
+        if not self.connected and not ignore_lock and not self._reconnecting:
             logger.debug(
                 'attempted to read while not being connected, return None'
             )
-            logger.debug('channel - read unlock')
-            self.read_lock = False
-            return '', None
+            return None, '', None
 
-        # select channel
-        s = self._connection  # type: socket.socket
-        f = self._file
+        # replies read by the receiving thread
+        if self.is_PC and not ignore_lock:
+            reply = self._wait_reply(wait, request_id)
+            return None if reply is None else (request_id, *reply)
+
+        # lock system
+        if not ignore_lock:
+            if self.read_lock.locked():
+                logger.debug('channel - read locked, waiting')
+            tic = time.perf_counter()
+            self.read_lock.acquire()
+            metrics.observe(
+                "channel.read_lock_wait", time.perf_counter() - tic
+            )
+        logger.debug('channel - read lock')
 
         # read and handle connection errors
         try:
-            # reading attempts: if failure, attempt to re-establish
-            # connection, then second attempt if on PC side, or return
-            # if on robot side
-
-            # First attempt to read
-            try:
-                # no waiting: short timeout
-                if not wait:
-                    s.settimeout(.001)
-
-                # name
-                two_bytes = s.recv(2)
-                if len(two_bytes) == 0:
-                    raise ConnectionAbortedError
-                if not wait:
-                    # some data is available, so now wait until it is
-                    # completely transmitted
-                    s.settimeout(TIMEOUT_READ)
-                n, = struct.unpack('<H', two_bytes)
-                name = f.read(n).decode()
-
-                # value
-                four_bytes = f.read(4)
-                if len(four_bytes) == 0:
-                    raise ConnectionAbortedError
-                n, = struct.unpack('<L', four_bytes)
-                value = pickle.loads(f.read(n))
-                # send receipt acknowledgment
-                self.first_no_data_time = None
-                return name, value
-
-            except Exception as err:
-                # remove timeout
-                if not wait:
-                    s.settimeout(TIMEOUT_READ)
-
+            message = self._read_frame(wait)
+            if message is None:
                 # no waiting: timeout just means that there is no data yet,
                 # return as long as the first read attempt was no longer
-                # than TIMEOUT_PC_READ before
-                if not wait and isinstance(err, socket.timeout):
-                    if self.first_no_data_time is None:
-                        self.first_no_data_time = time.time()
-                    if time.time() < self.first_no_data_time + TIMEOUT_READ:
-                        return None
-
-                # otherwise, there is a connection error
-                raise err
+                # than TIMEOUT_READ before
+                if self.first_no_data_time is None:
+                    self.first_no_data_time = time.time()
+                if time.time() < self.first_no_data_time + TIMEOUT_READ:
+                    return None
+                raise socket.timeout
+            self.first_no_data_time = None
+            return message
         except ConnectionResetError:
             logger.warning("Connection lost while reading object")
             self.cleanup()
         finally:
             if not ignore_lock:
-                self.read_lock = False
+                self.read_lock.release()
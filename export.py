@@ -0,0 +1,221 @@
+#  Reports and exports of the downloaded activities. The activities are
+#  converted to NumPy columns once, the summaries are computed on the whole
+#  columns and the files are written by blocks of rows.
+#  usage: python export.py [output directory]
+
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from activity_store import load_local_store
+from logger import logger
+
+EXPORT_DIR = "export"
+BLOCK_ROWS = 0x4000  # rows formatted and written at once
+
+
+def to_columns(store) -> dict:
+    """
+    :param store: an ActivityStore
+    :return: the task names and the task id, start, duration and local
+    start columns of the activities. The columns are copies, the store can
+    still grow.
+    """
+    names, task_ids, starts, durations = store.columns()
+    columns = {
+        "names": np.array(names, dtype=object),
+        "task": np.frombuffer(task_ids, dtype=np.uint32).copy(),
+        "start": np.frombuffer(starts, dtype=np.int64).copy(),
+        "duration": np.frombuffer(durations, dtype=np.uint32).copy(),
+    }
+    columns["local_start"] = columns["start"] + utc_offsets(columns["start"])
+    return columns
+
+
+def utc_offsets(starts: np.ndarray) -> np.ndarray:
+    """
+    :param starts: epochs
+    :return: the offset of the local time at each epoch, in seconds. The
+    offset is looked up once per hour of the epochs, not once per epoch.
+    """
+    hours, inverse = np.unique(starts // 3600, return_inverse=True)
+    offsets = np.array(
+        [time.localtime(int(hour) * 3600).tm_gmtoff for hour in hours],
+        dtype=np.int64
+    )
+    return offsets[inverse]
+
+
+def iso_times(local_starts: np.ndarray) -> np.ndarray:
+    return local_starts.astype('datetime64[s]').astype(str)
+
+
+def task_totals(columns) -> dict:
+    """
+    :return: the seconds spent on each task
+    """
+    totals = np.bincount(
+        columns["task"], weights=columns["duration"],
+        minlength=len(columns["names"])
+    )
+    return dict(zip(columns["names"].tolist(), totals.astype(int).tolist()))
+
+
+def overlaps(columns) -> dict:
+    """
+    Activities starting before the end of an earlier one, as happens when
+    the activities of several boards are merged
+    :return: the number of overlapping activities and the overlapping seconds
+    """
+    order = np.argsort(columns["start"], kind='stable')
+    starts = columns["start"][order]
+    durations = columns["duration"][order].astype(np.int64)
+    if len(starts) < 2:
+        return {"count": 0, "seconds": 0}
+    ends = np.maximum.accumulate(starts + durations)
+    overlap = np.clip(ends[:-1] - starts[1:], 0, durations[1:])
+    return {
+        "count": int(np.count_nonzero(overlap)),
+        "seconds": int(overlap.sum()),
+    }
+
+
+def daily_timeline(columns):
+    """
+    :return: the local days with activities, as YYYY-MM-DD, and the seconds
+    spent on each task each day, a days x tasks matrix. An activity counts on
+    the day of its start.
+    """
+    days, inverse = np.unique(
+        columns["local_start"] // 86400, return_inverse=True
+    )
+    matrix = np.zeros((len(days), len(columns["names"])), dtype=np.int64)
+    np.add.at(matrix, (inverse, columns["task"]), columns["duration"])
+    return days.astype('datetime64[D]').astype(str), matrix
+
+
+def _blocks(n: int):
+    for first in range(0, n, BLOCK_ROWS):
+        yield slice(first, min(first + BLOCK_ROWS, n))
+
+
+def write_csv(path: str, columns):
+    """
+    Writes the activities as task, local start and duration rows
+    :return:
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(("task", "start", "duration"))
+        for block in _blocks(len(columns["task"])):
+            writer.writerows(zip(
+                columns["names"][columns["task"][block]].tolist(),
+                iso_times(columns["local_start"][block]).tolist(),
+                columns["duration"][block].tolist()
+            ))
+
+
+def write_daily_csv(path: str, days, matrix, names):
+    """
+    Writes the daily timeline, one row per day and one column per task
+    :return:
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["day"] + list(names))
+        for block in _blocks(len(days)):
+            writer.writerows(
+                [day] + row
+                for day, row in zip(
+                    days[block].tolist(), matrix[block].tolist()
+                )
+            )
+
+
+def write_columnar(path: str, columns, days, matrix):
+    """
+    Writes the columns and the daily timeline in a NumPy .npz archive, one
+    raw array per column
+    :return:
+    """
+    np.savez(
+        path,
+        names=columns["names"].astype(str),
+        task=columns["task"],
+        start=columns["start"],
+        duration=columns["duration"],
+        days=days,
+        daily=matrix
+    )
+
+
+def write_json(path: str, columns, summary: dict):
+    """
+    Writes the summary and the activities, the activities being formatted a
+    block at a time instead of building the whole document in memory
+    :return:
+    """
+    with open(path, 'w') as f:
+        f.write(json.dumps(summary)[:-1])
+        f.write(', "activities": [')
+        separator = ''
+        for block in _blocks(len(columns["task"])):
+            rows = json.dumps(list(zip(
+                columns["task"][block].tolist(),
+                columns["start"][block].tolist(),
+                columns["duration"][block].tolist()
+            )))
+            f.write(separator + rows[1:-1])
+            separator = ', '
+        f.write(']}')
+
+
+def export_all(store, directory=EXPORT_DIR) -> dict:
+    """
+    Exports the activities and their summaries in CSV, npz and JSON
+    :param store: an ActivityStore
+    :param directory: the output directory
+    :return: the time of each step, in seconds
+    """
+    os.makedirs(directory, exist_ok=True)
+    timings = dict()
+    tic = time.perf_counter()
+    columns = to_columns(store)
+    timings["columns"] = time.perf_counter() - tic
+    tic = time.perf_counter()
+    days, matrix = daily_timeline(columns)
+    summary = {
+        "tasks": columns["names"].tolist(),
+        "totals": task_totals(columns),
+        "overlaps": overlaps(columns),
+        "days": days.tolist(),
+        "daily": matrix.tolist(),
+    }
+    timings["summaries"] = time.perf_counter() - tic
+    tic = time.perf_counter()
+    write_csv(os.path.join(directory, "activities.csv"), columns)
+    write_daily_csv(
+        os.path.join(directory, "daily.csv"), days, matrix, summary["tasks"]
+    )
+    timings["csv"] = time.perf_counter() - tic
+    tic = time.perf_counter()
+    write_columnar(
+        os.path.join(directory, "activities.npz"), columns, days, matrix
+    )
+    timings["npz"] = time.perf_counter() - tic
+    tic = time.perf_counter()
+    write_json(os.path.join(directory, "activities.json"), columns, summary)
+    timings["json"] = time.perf_counter() - tic
+    logger.info(
+        f"{len(store)} activities exported to {directory} in "
+        f"{sum(timings.values()):.3f} s"
+    )
+    return timings
+
+
+if __name__ == '__main__':
+    print(export_all(load_local_store()["store"], *sys.argv[1:2]))
@@ -0,0 +1,379 @@
+import functools
+import io
+import struct
+import zlib
+
+from codec import codec_for
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+STREAM = 0xFFFFFFFF  # length of a value sent as a stream of chunks
+CHUNK_SIZE = 0x1000
+
+_CHUNK = struct.Struct('<L')
+_COMPRESSION = struct.Struct('<B')
+_NAME = struct.Struct('<H')
+_REQUEST_ID = struct.Struct('<L')
+_VALUE = struct.Struct('<BL')  # codec id, length of the value or STREAM
+
+
+class _NoCompressor:
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class _NoDecompressor:
+    def decompress(self, data):
+        return data
+
+
+class _LZ4Compressor:
+    def __init__(self):
+        self._compressor = lz4.frame.LZ4FrameCompressor()
+        self._begun = False
+
+    def compress(self, data):
+        x = self._compressor.compress(data)
+        if not self._begun:
+            self._begun = True
+            x = self._compressor.begin() + x
+        return x
+
+    def flush(self):
+        if not self._begun:
+            return self._compressor.begin() + self._compressor.flush()
+        return self._compressor.flush()
+
+
+class _LZ4Decompressor:
+    def __init__(self):
+        self._decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+# name: (id on the wire, compressor factory, decompressor factory), the order
+# is the order of preference
+COMPRESSIONS = {
+    "zlib": (1, lambda: zlib.compressobj(6), zlib.decompressobj),
+    "none": (0, _NoCompressor, _NoDecompressor),
+}
+if lz4 is not None:
+    COMPRESSIONS = {
+        "lz4": (2, _LZ4Compressor, _LZ4Decompressor), **COMPRESSIONS
+    }
+_DECOMPRESSORS = {
+    i: decompressor for i, _, decompressor in COMPRESSIONS.values()
+}
+
+
+def negotiate_compression(offered):
+    """
+    Picks the preferred compression among the ones offered by the other side
+    :param offered: the names of the compressions of the other side
+    :return: the name of the compression, "none" if nothing matches
+    """
+    for name in COMPRESSIONS:
+        if name in offered:
+            return name
+    return "none"
+
+
+class ChunkWriter:
+    """
+    File-like object writing what it receives as compressed chunks of bounded
+    size, the stream ends with an empty chunk. A value can then be pickled
+    directly into it, without holding the whole serialized value in memory.
+    """
+
+    def __init__(self, f, compression="none", chunk_size=CHUNK_SIZE,
+                 skip=0):
+        """
+        :param f: the file-like object to write to
+        :param compression: the name of the compression
+        :param chunk_size: the size of the compressed chunks
+        :param skip: the number of first chunks not to write, already
+        received by the other side before the connection was lost
+        """
+        self._file = f
+        compression_id, compressor, _ = COMPRESSIONS[compression]
+        self._compressor = compressor()
+        self._chunk_size = chunk_size
+        self._skip = skip
+        self._buffer = bytearray()
+        self._file.write(_COMPRESSION.pack(compression_id))
+
+    def write(self, data):
+        self._buffer += self._compressor.compress(data)
+        while len(self._buffer) >= self._chunk_size:
+            self._write_chunk(self._buffer[:self._chunk_size])
+            del self._buffer[:self._chunk_size]
+        return len(data)
+
+    def _write_chunk(self, chunk):
+        if self._skip:
+            self._skip -= 1
+            return
+        self._file.write(_CHUNK.pack(len(chunk)))
+        self._file.write(chunk)
+
+    def close(self):
+        self._buffer += self._compressor.flush()
+        for i in range(0, len(self._buffer), self._chunk_size):
+            self._write_chunk(self._buffer[i:i + self._chunk_size])
+        self._buffer.clear()
+        self._file.write(_CHUNK.pack(0))
+
+
+class ChunkReader:
+    """
+    File-like object reading the chunks written by a ChunkWriter, the chunks
+    are decompressed one at a time as the value is unpickled.
+    """
+
+    def __init__(self, f, progress=None, chunks=None):
+        """
+        :param f: the file-like object to read from
+        :param progress: called with the number of bytes received so far
+        after each chunk
+        :param chunks: list of the compressed chunks received so far, when
+        an interrupted transfer is resumed: they are read before the chunks
+        of the file, which are appended to the list
+        """
+        self._file = f
+        self._progress = progress
+        self._chunks = chunks
+        self._received_chunks = iter(list(chunks or ()))
+        self.received = 0
+        compression_id, = _COMPRESSION.unpack(self._read_exactly(1))
+        self._decompressor = _DECOMPRESSORS[compression_id]()
+        self._buffer = bytearray()
+        self._ended = False
+
+    def _read_exactly(self, n):
+        x = self._file.read(n)
+        if len(x) < n:
+            raise ConnectionAbortedError
+        return x
+
+    def _next_chunk(self):
+        chunk = next(self._received_chunks, None)
+        if chunk is None:
+            n, = _CHUNK.unpack(self._read_exactly(_CHUNK.size))
+            if n == 0:
+                self._ended = True
+                return
+            chunk = self._read_exactly(n)
+            if self._chunks is not None:
+                self._chunks.append(chunk)
+        self._buffer += self._decompressor.decompress(chunk)
+        self.received += _CHUNK.size + len(chunk)
+        if self._progress is not None:
+            self._progress(self.received)
+
+    def read(self, n=-1):
+        while not self._ended and (n < 0 or len(self._buffer) < n):
+            self._next_chunk()
+        if n < 0:
+            n = len(self._buffer)
+        x = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return x
+
+    def readline(self):
+        while not self._ended and b'\n' not in self._buffer:
+            self._next_chunk()
+        n = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        return self.read(n)
+
+    def drain(self):
+        """
+        Reads the remaining chunks, up to the end of the stream
+        :return:
+        """
+        while not self._ended:
+            self._next_chunk()
+        self._buffer.clear()
+
+
+class CountingWriter:
+    """
+    File-like object counting the bytes written to another one
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+
+class SocketReader:
+    """
+    Buffered reader over a socket. Unlike the file of `socket.makefile`, it
+    can still be used after a timeout: the bytes received before the timeout
+    stay in the buffer.
+    """
+
+    def __init__(self, s, buffer_size=0x10000):
+        self._socket = s
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self.consumed = 0  # bytes read so far
+
+    @property
+    def pending(self) -> bool:
+        return len(self._buffer) > 0
+
+    def wait(self):
+        """
+        Waits for data to be available, a timeout of the socket then leaves
+        nothing half read
+        :return:
+        """
+        if not self._buffer:
+            x = self._socket.recv(self._buffer_size)
+            if len(x) == 0:
+                raise ConnectionAbortedError
+            self._buffer += x
+
+    def read(self, n):
+        while len(self._buffer) < n:
+            x = self._socket.recv(
+                max(self._buffer_size, n - len(self._buffer))
+            )
+            if len(x) == 0:
+                raise ConnectionAbortedError
+            self._buffer += x
+        x = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        self.consumed += n
+        return x
+
+
+def write_message(f, request_id, name, value, codec=None, compression=None,
+                  skip=0):
+    """
+    Writes a message: its name, its request id and its value, encoded with
+    the codec and, if a compression is given, streamed as compressed chunks
+    :param f: the file-like object to write to
+    :param request_id: the request id of the message
+    :param name: the name of the message
+    :param value: the value of the message
+    :param codec: the name of the negotiated codec, None before negotiation
+    :param compression: the name of the compression, None to send the value
+    in one piece
+    :param skip: the number of first chunks not to write, when resuming the
+    transfer of a value. The encoding of a value is deterministic, the
+    chunks are the same as the first time.
+    :return:
+    """
+    x = str.encode(name)
+    f.write(_NAME.pack(len(x)))
+    f.write(x)
+    f.write(_REQUEST_ID.pack(request_id))
+    codec = codec_for(codec, name)
+    if compression is not None:
+        f.write(_VALUE.pack(codec.id, STREAM))
+        writer = ChunkWriter(f, compression, skip=skip)
+        codec.dump(name, value, writer)
+        writer.close()
+    else:
+        x = codec.dumps(name, value)
+        f.write(_VALUE.pack(codec.id, len(x)))
+        f.write(x)
+
+
+def _check_codec(codec_id: int, negotiated, name: str):
+    """
+    :param codec_id: the id of the codec of a message received
+    :param negotiated: see codec_for
+    :param name: the name of the message
+    :return: the codec of the message
+    :raise ConnectionAbortedError: the message does not use the negotiated
+    codec, the other side cannot be trusted any more
+    """
+    codec = codec_for(negotiated, name)
+    if codec_id != codec.id:
+        raise ConnectionAbortedError(
+            f"{name} received with codec {codec_id}, {codec.name} expected"
+        )
+    return codec
+
+
+def read_message(f, progress=None, chunks=None, codec=None):
+    """
+    Reads a message written by write_message
+    :param f: the file-like object to read from
+    :param progress: called with the request id and the number of bytes
+    received so far after each chunk of a streamed value
+    :param chunks: called with the request id of a streamed value, returns
+    the list of its chunks received so far, see ChunkReader, or None not to
+    keep them
+    :param codec: the name of the negotiated codec, None before negotiation
+    :return: (request id, name, value)
+    """
+    n, = _NAME.unpack(f.read(_NAME.size))
+    name = f.read(n).decode()
+    request_id, = _REQUEST_ID.unpack(f.read(_REQUEST_ID.size))
+    codec_id, n = _VALUE.unpack(f.read(_VALUE.size))
+    codec = _check_codec(codec_id, codec, name)
+    if n == STREAM:
+        reader = ChunkReader(
+            f, progress and functools.partial(progress, request_id),
+            chunks and chunks(request_id)
+        )
+        value = codec.load(name, reader)
+        reader.drain()
+    else:
+        value = codec.loads(name, f.read(n))
+    return request_id, name, value
+
+
+async def read_message_async(reader, codec=None):
+    """
+    Reads a message written by write_message from an asyncio stream, the
+    compressed chunks of a streamed value are decoded once all received
+    :param reader: the asyncio.StreamReader to read from
+    :param codec: the name of the negotiated codec, None before negotiation
+    :return: (request id, name, value)
+    """
+    n, = _NAME.unpack(await reader.readexactly(_NAME.size))
+    name = (await reader.readexactly(n)).decode()
+    request_id, = _REQUEST_ID.unpack(
+        await reader.readexactly(_REQUEST_ID.size)
+    )
+    codec_id, n = _VALUE.unpack(await reader.readexactly(_VALUE.size))
+    codec = _check_codec(codec_id, codec, name)
+    if n == STREAM:
+        raw = bytearray(await reader.readexactly(_COMPRESSION.size))
+        while True:
+            header = await reader.readexactly(_CHUNK.size)
+            raw += header
+            n, = _CHUNK.unpack(header)
+            if n == 0:
+                break
+            raw += await reader.readexactly(n)
+        value = codec.load(name, ChunkReader(io.BytesIO(raw)))
+    else:
+        value = codec.loads(name, await reader.readexactly(n))
+    return request_id, name, value
@@ -0,0 +1,227 @@
+import os
+import pickle
+import struct
+import uuid
+import zlib
+
+from activity_store import ActivityStore
+from logger import logger
+from metrics import metrics
+
+ACTIVITY_TABLE = "activity_table.pkl"
+JOURNAL_FILE = "activity_journal.log"
+
+# record kinds
+GENERATION = 0
+FLOAT_START = 1  # start with a float epoch, written by former versions
+HEARTBEAT = 2
+STOP = 3
+CLOCK = 4
+START = 5
+
+_HEADER = struct.Struct('<BH')  # kind, payload length
+_CRC = struct.Struct('<L')
+_FLOAT_START = struct.Struct('<d')
+_START = struct.Struct('<q')  # epoch of the start, followed by the task name
+_DURATION = struct.Struct('<L')
+_GENERATION = struct.Struct('<L')
+_CLOCK = struct.Struct('<q')  # jump of the wall clock, in seconds
+
+
+class ActivityJournal:
+    """
+    Append-only journal of the activities. Instead of re-pickling the whole
+    history every second, each start, heartbeat and stop is appended as a
+    small record, so the cost of a write does not depend on the size of the
+    history. The history itself is kept in a snapshot (the former activity
+    table) which is rewritten only when the journal is compacted. Each record
+    carries a checksum: a record torn by a power loss is dropped at recovery.
+    The snapshot and the journal share a generation number, a journal that
+    was already folded into the snapshot is never replayed twice.
+    """
+
+    def __init__(self, path=JOURNAL_FILE, snapshot_path=ACTIVITY_TABLE,
+                 sync_every=10, compact_every=3600):
+        """
+        :param path: the journal file
+        :param snapshot_path: the snapshot of the history
+        :param sync_every: number of heartbeats between two fsync, starts and
+        stops are always synced
+        :param compact_every: number of records after which the journal should
+        be folded into the snapshot
+        """
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.sync_every = sync_every
+        self.compact_every = compact_every
+        self._file = None
+        self._records = 0
+        self._unsynced = 0
+        self._generation = 0
+        # identity of the history, kept as long as the snapshot: a new one
+        # tells the PC the history of the board was reset
+        self.history = None
+
+    def recover(self):
+        """
+        Loads the snapshot, replays the journal on top of it and compacts the
+        result, dropping any torn record at the end of the journal.
+        :return: the activity store
+        """
+        store = ActivityStore()
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+            if isinstance(snapshot, dict):
+                self._generation = snapshot["generation"]
+                self.history = snapshot.get("history")
+                store = snapshot["data"]
+                if isinstance(store, tuple):  # snapshot of the former tables
+                    store = ActivityStore.from_tuple(store)
+            else:  # activity table written before the journal
+                store = ActivityStore.from_tuple(snapshot)
+        replayed = 0
+        running = False
+        for kind, payload in self._replay():
+            if kind in (START, FLOAT_START):
+                header = _START if kind == START else _FLOAT_START
+                when, = header.unpack_from(payload)
+                store.append(payload[header.size:].decode(), when)
+                running = True
+            elif kind == CLOCK:
+                if running:
+                    jump, = _CLOCK.unpack(payload)
+                    store.set_start(store.get_start() + jump)
+            elif len(store):  # heartbeat or stop
+                store.set_duration(*_DURATION.unpack(payload))
+                running = kind != STOP
+            replayed += 1
+        if replayed:
+            logger.info(f"Recovered {replayed} records from the journal")
+        if self.history is None:
+            self.history = uuid.uuid4().hex
+            logger.info(f"new history {self.history}")
+        self.compact(store)
+        return store
+
+    def _replay(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        records = self._parse(content)
+        for kind, payload in records:
+            if kind != GENERATION:
+                break
+            generation, = _GENERATION.unpack(payload)
+            if generation != self._generation:
+                logger.info("journal already in the snapshot, skipped")
+                return
+            yield from records
+            return
+
+    @staticmethod
+    def _parse(content):
+        offset = 0
+        while offset + _HEADER.size <= len(content):
+            kind, length = _HEADER.unpack_from(content, offset)
+            end = offset + _HEADER.size + length
+            if end + _CRC.size > len(content):
+                break
+            crc, = _CRC.unpack_from(content, end)
+            if crc != zlib.crc32(content[offset:end]):
+                break
+            yield kind, content[offset + _HEADER.size:end]
+            offset = end + _CRC.size
+        if offset < len(content):
+            logger.warning(
+                f"Dropping {len(content) - offset} bytes of torn journal"
+            )
+
+    def _append(self, kind, payload, sync):
+        with metrics.timer("journal.write"):
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            record = _HEADER.pack(kind, len(payload)) + payload
+            self._file.write(record + _CRC.pack(zlib.crc32(record)))
+            self._file.flush()
+            self._records += 1
+            self._unsynced += 1
+            if sync or self._unsynced >= self.sync_every:
+                self.sync()
+
+    def sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def start(self, task: str, when: int):
+        """
+        Records the start of a task
+        :param task: the name of the task
+        :param when: the epoch of the start
+        :return:
+        """
+        self._append(START, _START.pack(when) + task.encode(), sync=True)
+
+    def clock(self, jump: int):
+        """
+        Records a change of the wall clock, the start of the running task, if
+        any, moves along with it
+        :param jump: the change of the clock, in seconds
+        :return:
+        """
+        self._append(CLOCK, _CLOCK.pack(jump), sync=True)
+
+    def heartbeat(self, duration: int):
+        """
+        Records the current duration of the running task, fsync is batched
+        :param duration: the duration in seconds
+        :return:
+        """
+        self._append(HEARTBEAT, _DURATION.pack(duration), sync=False)
+
+    def stop(self, duration: int):
+        """
+        Records the final duration of the running task
+        :param duration: the duration in seconds
+        :return:
+        """
+        self._append(STOP, _DURATION.pack(duration), sync=True)
+
+    @property
+    def needs_compaction(self):
+        return self._records >= self.compact_every
+
+    def compact(self, data):
+        """
+        Folds the journal into the snapshot: the snapshot is atomically
+        replaced before the journal is emptied, a crash in between leaves a
+        journal of the previous generation which is skipped at recovery.
+        :param data: the activity store
+        :return:
+        """
+        self._generation += 1
+        tmp_path = self.snapshot_path + ".tmp"
+        with metrics.timer("journal.compact"), open(tmp_path, 'wb') as f:
+            pickle.dump({
+                "generation": self._generation,
+                "history": self.history,
+                "data": data,
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.close()
+        self._file = open(self.path, 'wb')
+        self._append(
+            GENERATION, _GENERATION.pack(self._generation), sync=True
+        )
+        self._records = 0
+        logger.debug("journal compacted")
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
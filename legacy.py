@@ -0,0 +1,63 @@
+#  Converter of the data written by former versions, where the start of each
+#  activity is a time.asctime string, to epoch-based activity stores. The
+#  converted activities go to the analytics store of the server.
+#  usage: python legacy.py activity_table.pkl|timetable.csv [board name]
+#  The board itself migrates its activity table when it starts.
+
+import csv
+import pickle
+import sys
+
+from activity_store import ActivityStore, parse_asctime
+from analytics import AnalyticsStore
+from logger import logger
+
+
+def read_activity_table(path: str) -> ActivityStore:
+    """
+    :param path: a former activity table, the pickled (durations, asctime
+    starts, tasks) lists
+    :return: the activities
+    """
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    if isinstance(data, dict):  # snapshot of the journal
+        data = data["data"]
+    if isinstance(data, ActivityStore):
+        return data
+    return ActivityStore.from_tuple(data)
+
+
+def read_timetable(path: str) -> ActivityStore:
+    """
+    :param path: a timetable written by the server, (task, asctime start,
+    duration) rows
+    :return: the activities
+    """
+    store = ActivityStore()
+    with open(path, newline='') as f:
+        for task, date, duration in csv.reader(f):
+            store.append(task, parse_asctime(date), int(duration))
+    return store
+
+
+def convert(path: str, board="legacy") -> ActivityStore:
+    """
+    Converts a former file and merges its activities in the analytics store
+    :param path: the activity table (.pkl) or the timetable (.csv)
+    :param board: the board name of the activities in the analytics store
+    :return: the activities
+    """
+    if path.endswith(".csv"):
+        store = read_timetable(path)
+    else:
+        store = read_activity_table(path)
+    analytics = AnalyticsStore()
+    analytics.merge(0, store, board)
+    analytics.close()
+    logger.info(f"{len(store)} activities converted from {path}")
+    return store
+
+
+if __name__ == '__main__':
+    convert(*sys.argv[1:3])
@@ -1,25 +1,67 @@
+import atexit
 import logging
+import queue
 import sys
 import os
-from logging.handlers import RotatingFileHandler
-
-_log_file_name = 'log/time_tracker.log'
-if not os.path.isdir("log"):
-    os.mkdir("log")
-
-_log_handler = RotatingFileHandler(
-    _log_file_name, maxBytes=0xfffff, backupCount=5
-)  # 1 Mio - 1 o, 5 old log files
-_log_handler.setLevel(logging.INFO)
-
-logger = logging.Logger("logger")
-
-_format = logging.Formatter(
-    '%(levelname)s: %(thread)d: %(asctime)s: %(message)s'
-)
-_log_handler.setFormatter(_format)
-logger.addHandler(_log_handler)
-_stdout_handler = logging.StreamHandler(sys.stdout)
-_stdout_handler.setLevel(logging.DEBUG)
-logger.addHandler(_stdout_handler)
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FILE = 'log/time_tracker.log'
+LOG_LEVEL = logging.INFO  # logging.DEBUG for the messages of the channel
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    Queues the records as they are: the message is formatted by the writer
+    thread, not by the thread logging it. The arguments of a message should
+    not be modified after the call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def make_handlers(path=LOG_FILE, stream=sys.stdout) -> list:
+    """
+    :return: the handlers of the messages, a rotating file and a stream
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.mkdir(directory)
+    log_handler = RotatingFileHandler(
+        path, maxBytes=0xfffff, backupCount=5
+    )  # 1 Mio - 1 o, 5 old log files
+    log_handler.setLevel(logging.INFO)
+    _format = logging.Formatter(
+        '%(levelname)s: %(thread)d: %(asctime)s: %(message)s'
+    )
+    log_handler.setFormatter(_format)
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setLevel(logging.DEBUG)
+    return [log_handler, stream_handler]
+
+
+def queue_logger(name: str, handlers: list, level=LOG_LEVEL):
+    """
+    Makes a logger whose calling thread only puts the records in a queue, a
+    background thread formats them and passes them to the handlers. Messages
+    below the level are dropped before anything is done, so a message should
+    be given with %-style arguments rather than as an f-string on the hot
+    paths.
+    :param name: the name of the logger
+    :param handlers: the handlers, run by the background thread
+    :param level: the level of the logger
+    :return: the logger and the listener running the handlers
+    """
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    _logger = logging.getLogger(name)
+    _logger.setLevel(level)
+    _logger.propagate = False
+    _logger.addHandler(_LazyQueueHandler(records))
+    return _logger, listener
+
+
+logger, _listener = queue_logger("logger", make_handlers())
+atexit.register(_listener.stop)  # writes the records still in the queue
 logger.debug("Logger setup")
@@ -0,0 +1,201 @@
+#  Runtime metrics of the board: counters, latency histograms and gauges,
+#  cheap enough to stay on in production. They are sent to the PC with the
+#  "stats" command and written locally with `dump`, e.g. on SIGUSR1.
+#  usage: python metrics.py [metrics file]
+
+import bisect
+import cProfile
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from logger import logger
+
+METRICS_FILE = "metrics.json"
+
+# upper bounds of the buckets of the histograms, in seconds: 4 buckets per
+# decade from 1 us to 10 s, the last bucket has no upper bound
+_BOUNDS = tuple(10 ** (e / 4) for e in range(-24, 5))
+
+
+class Histogram:
+    """
+    Distribution of durations in fixed logarithmic buckets: recording a
+    duration is a bisection and an increment, whatever the number of
+    durations. The quantiles are the upper bounds of their buckets, within
+    a factor 1.8 of the real ones.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """
+        :param q: the quantile, between 0 and 1
+        :return: the upper bound of the bucket of the quantile
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(_BOUNDS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """
+        :return: count, mean, median, 95th and 99th percentiles and maximum,
+        in seconds
+        """
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "p50": self.quantile(.5),
+            "p95": self.quantile(.95),
+            "p99": self.quantile(.99),
+            "max": self.max,
+        }
+
+
+class MetricsRegistry:
+    """
+    Named counters, histograms and gauges, safe to update from any thread.
+    A gauge is a function called when the metrics are read.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.counters = dict()
+        self.histograms = dict()
+        self.gauges = dict()
+
+    def count(self, name: str, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, value: float):
+        """
+        Records a duration
+        :param name: the name of the histogram
+        :param value: the duration, in seconds
+        :return:
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Records the duration of a block in a histogram
+        """
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - tic)
+
+    def gauge(self, name: str, function):
+        """
+        :param name: the name of the gauge
+        :param function: called without argument when the metrics are read
+        :return:
+        """
+        self.gauges[name] = function
+
+    def snapshot(self) -> dict:
+        """
+        :return: the uptime, the counters, the summaries of the histograms
+        and the values of the gauges
+        """
+        with self._lock:
+            snapshot = {
+                "uptime": time.monotonic() - self._started,
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: histogram.summary()
+                    for name, histogram in self.histograms.items()
+                },
+            }
+        snapshot["gauges"] = {
+            name: function() for name, function in self.gauges.items()
+        }
+        return snapshot
+
+    def dump(self, path=METRICS_FILE):
+        """
+        Writes the snapshot of the metrics in a JSON file
+        :return:
+        """
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1, default=repr)
+        logger.info(f"metrics written to {path}")
+
+    def reset(self):
+        with self._lock:
+            self._started = time.monotonic()
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def profiled(target, path: str):
+    """
+    Runs a function under cProfile, only its own thread is profiled. The
+    statistics are written when it returns or raises, to be read with
+    `python -m pstats path`.
+    :param target: the function, called without argument
+    :param path: the file of the statistics
+    :return: what the function returns
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(target)
+    finally:
+        profiler.dump_stats(path)
+        logger.info(f"profile written to {path}")
+
+
+metrics = MetricsRegistry()
+metrics.gauge("threads", threading.active_count)
+metrics.gauge(
+    "thread names", lambda: sorted(t.name for t in threading.enumerate())
+)
+
+
+def print_snapshot(snapshot: dict):
+    print(f"uptime {snapshot['uptime']:.0f} s")
+    for name, value in sorted(snapshot["counters"].items()):
+        print(f"  {name:<32} {value:>12}")
+    for name, summary in sorted(snapshot["histograms"].items()):
+        if not summary["count"]:
+            continue
+        print(
+            f"  {name:<32} {summary['count']:>12} x, mean "
+            f"{summary['mean'] * 1e3:8.3f} ms, p95 "
+            f"{summary['p95'] * 1e3:8.3f} ms, max "
+            f"{summary['max'] * 1e3:8.3f} ms"
+        )
+    for name, value in sorted(snapshot["gauges"].items()):
+        print(f"  {name:<32} {value}")
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1] if len(sys.argv) > 1 else METRICS_FILE) as f:
+        print_snapshot(json.load(f))
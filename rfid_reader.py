@@ -0,0 +1,111 @@
+import time
+from collections import deque
+
+from logger import logger
+from metrics import metrics
+
+
+class TagReader:
+    """
+    Low latency reading of the tags. Instead of a blocking wait followed by a
+    fixed pause, the reader waits for a tag during a short poll window, so a
+    tag swap is seen within a fraction of a second. A tag is reported once it
+    has been read `debounce` times in a row, and a tag already reported is
+    not reported again while it stays on the reader. The latency between the
+    first read of a tag and its record is measured to tune the settings.
+    """
+
+    def __init__(self, rc522, poll_window=.1, debounce=2, duplicate_window=2.,
+                 latency_samples=100):
+        """
+        :param rc522: the RFID device
+        :param poll_window: maximum time to wait for a tag in a read, in
+        seconds
+        :param debounce: number of consecutive reads of a tag before it is
+        reported
+        :param duplicate_window: time after which a tag still reported must
+        be missing to be reported again, in seconds
+        :param latency_samples: number of latencies kept for the report
+        """
+        self.rc522 = rc522
+        self.poll_window = poll_window
+        self.debounce = debounce
+        self.duplicate_window = duplicate_window
+        self.errors = 0
+        self._candidate = None
+        self._candidate_count = 0
+        self._candidate_since = None
+        self._reported = None
+        self._reported_seen = -float('inf')
+        self._latencies = deque(maxlen=latency_samples)
+
+    def read_uid(self):
+        """
+        Reads the uid of the tag on the reader, if any
+        :return: the uid, None if no tag could be read
+        """
+        error, tag_type = self.rc522.request()
+        if not error:
+            error, uid = self.rc522.anticoll()
+            if not error:
+                metrics.count("rfid.tag_reads")
+                return uid
+            metrics.count("rfid.anticoll_errors")
+        self.errors += 1
+        return None
+
+    def read(self):
+        """
+        Waits at most a poll window for a tag
+        :return: the uid of a new tag and the monotonic time of its first read,
+        None if there is no new tag
+        """
+        self.rc522.wait_for_tag(self.poll_window)
+        now = time.monotonic()
+        uid = self.read_uid()
+        if uid is None:
+            self._candidate = None
+            return None
+        if uid != self._candidate:
+            self._candidate = uid
+            self._candidate_count = 0
+            self._candidate_since = now
+        self._candidate_count += 1
+        if self._candidate_count < self.debounce:
+            return None
+        if uid == self._reported \
+                and now - self._reported_seen < self.duplicate_window:
+            self._reported_seen = now
+            # the tag stays on the reader: no need to read it continuously
+            time.sleep(self.poll_window)
+            return None
+        self._reported = uid
+        self._reported_seen = now
+        return uid, self._candidate_since
+
+    def record_latency(self, detected_at: float):
+        """
+        :param detected_at: the monotonic time of the first read of the tag
+        just recorded
+        :return:
+        """
+        latency = time.monotonic() - detected_at
+        self._latencies.append(latency)
+        metrics.observe("rfid.read_to_record", latency)
+        logger.info("tag recorded %.0f ms after its read", latency * 1000)
+
+    def latency_report(self) -> dict:
+        """
+        :return: count, mean, median, 95th percentile and maximum of the last
+        tag-to-record latencies, in seconds
+        """
+        latencies = sorted(self._latencies)
+        if not latencies:
+            return {"count": 0}
+        return {
+            "count": len(latencies),
+            "mean": sum(latencies) / len(latencies),
+            "median": latencies[len(latencies) // 2],
+            "p95": latencies[int(.95 * (len(latencies) - 1))],
+            "max": latencies[-1],
+        }
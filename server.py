@@ -1,23 +1,151 @@
 import time
 
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QHBoxLayout, \
-    QPushButton, QDialog, QLineEdit, QGridLayout
+    QPushButton, QDialog, QLineEdit, QGridLayout, QProgressBar, QLabel, \
+    QInputDialog
 
-from communication import CommunicationChannel
+from activity_store import download_cursor, load_local_store, \
+    merge_download, save_local_store
+from analytics import AnalyticsStore
+from communication import CommandFailed, CommunicationChannel, \
+    RequestCancelled
 from logger import logger
+from transport import transport_from_url
 import csv
 
 TIMETABLE = "timetable.csv"
+# None for RFCOMM, else e.g. "tcp://raspberrypi.local:4242"
+TRANSPORT = None
+
+
+class ChannelService(QObject):
+    """
+    Channel I/O of the window, run in its own thread so the window never
+    waits for the board. The window calls the slots through signals, the
+    results come back as signals.
+    """
+    connected = pyqtSignal()
+    disconnected = pyqtSignal()
+    failed = pyqtSignal(str)
+    progress = pyqtSignal(int)  # bytes of the download received so far
+    downloaded = pyqtSignal(object)
+
+    def __init__(self):
+        super(ChannelService, self).__init__()
+        self.channel = CommunicationChannel(
+            transport=transport_from_url(TRANSPORT) if TRANSPORT else None
+        )
+        # the reconnection gave up, the window is told from the receiving
+        # thread of the channel
+        self.channel.on_lost = self.disconnected.emit
+
+    @property
+    def is_closed(self):
+        return self.channel.is_closed
+
+    @pyqtSlot(object)
+    def connect_board(self, cursor):
+        """
+        Connects, sets the time of the board, starts the reading and
+        downloads the activities since the cursor, in one round trip
+        :param cursor: the cursor of the last download, see download_cursor
+        :return:
+        """
+        logger.info("> Attempt connection")
+        try:
+            self.channel.check_hand()
+        except (OSError, ConnectionError):
+            logger.warning("Connection failed")
+            self.failed.emit("Connection failed")
+            return
+        # the board is connected from here: any failure leaves the channel
+        # closed rather than half set up
+        try:
+            batch = self.channel.batch()
+            batch.command("set_time", int(time.time()))
+            batch.command("read")
+            send = batch.command("send", cursor)
+            reply, data = batch.flush(progress=self.progress.emit)[send]
+            if reply == "error":
+                raise CommandFailed(data)
+        except RequestCancelled:
+            logger.info("Connection cancelled")
+            self.channel.cleanup()
+            self.failed.emit("Connection cancelled")
+            return
+        except (OSError, ConnectionError, CommandFailed) as err:
+            logger.warning(f"Connection failed: {err!r}")
+            self.channel.cleanup()
+            self.failed.emit("Connection failed")
+            return
+        self.connected.emit()
+        self.downloaded.emit(data)
+
+    @pyqtSlot()
+    def disconnect_board(self):
+        self.channel.disconnect()
+        self.disconnected.emit()
+
+    @pyqtSlot(str, object)
+    def send(self, name, value):
+        try:
+            self.channel.send_command(name, value)
+        except OSError as err:
+            logger.warning(f"Sending {name} failed: {err}")
+            self.failed.emit(f"Sending {name} failed")
+
+    @pyqtSlot(object)
+    def download(self, cursor):
+        try:
+            _, data = self.channel.request(
+                "send", cursor, progress=self.progress.emit
+            )
+            self.downloaded.emit(data)
+        except RequestCancelled:
+            logger.info("Download cancelled")
+            self.failed.emit("Download cancelled")
+        except (OSError, ConnectionError, CommandFailed) as err:
+            logger.warning(f"Download failed: {err!r}")
+            self.failed.emit("Download failed")
+
+    def cancel(self):
+        """
+        Cancels the pending download, called from the thread of the window
+        :return:
+        """
+        self.channel.cancel()
 
 
 class Window(QMainWindow):
-    worktable = None
+    # calls of the channel service, run in its thread
+    connect_board = pyqtSignal(object)
+    disconnect_board = pyqtSignal()
+    send = pyqtSignal(str, object)
+    download = pyqtSignal(object)
 
     def __init__(self):
         super(Window, self).__init__()
         self.setWindowTitle("Keep track of your workload!")
 
-        self.channel = CommunicationChannel()
+        self._state = load_local_store()
+        self.worktable = self._state["store"]
+        self.analytics = AnalyticsStore()
+        self._connected = False
+
+        self._service_thread = QThread()
+        self.service = ChannelService()
+        self.service.moveToThread(self._service_thread)
+        self.connect_board.connect(self.service.connect_board)
+        self.disconnect_board.connect(self.service.disconnect_board)
+        self.send.connect(self.service.send)
+        self.download.connect(self.service.download)
+        self.service.connected.connect(self._on_connected)
+        self.service.disconnected.connect(self._on_disconnected)
+        self.service.failed.connect(self._on_failed)
+        self.service.progress.connect(self._on_progress)
+        self.service.downloaded.connect(self._on_downloaded)
+        self._service_thread.start()
 
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
@@ -25,15 +153,21 @@ class Window(QMainWindow):
         central_widget.setLayout(self.layout)
         self._buttons = dict()
         buttons = (
-            "Connection", "Read Tag", "Write Tag", "Download workload", "stop"
+            "Connection", "Read Tag", "Write Tag", "Enroll Tags",
+            "Download workload", "stop", "Cancel", "Export"
         )
         funcs = (
-            self._connect, self._read, self._write, self._download,
-            self._stop_reading
+            self._connect, self._read, self._write, self._enroll,
+            self._download, self._stop_reading, self._cancel, self._export
         )
-        enabled = (True, False, False, False, False)
+        enabled = (True, False, False, False, False, False, False, True)
         for b, f, e in zip(buttons, funcs, enabled):
             self._make_button(b, f, e)
+        self._progress_bar = QProgressBar()
+        self._progress_bar.setVisible(False)
+        self.layout.addWidget(self._progress_bar)
+        self._status = QLabel()
+        self.layout.addWidget(self._status)
 
     def _make_button(self, name: str, func, set_enabled=True):
         button = QPushButton(name)
@@ -42,28 +176,51 @@ class Window(QMainWindow):
         self.layout.addWidget(button)
         self._buttons[name] = button
 
+    def _set_buttons(self, connected: bool):
+        for name, b in self._buttons.items():
+            b.setEnabled(
+                name in ("Connection", "Export")
+                or connected and name != "Cancel"
+            )
+
     def _connect(self):
-        logger.info("> Attempt connection")
-        if self.channel.is_closed:
-            try:
-                self.channel.check_hand()
-                self.channel.send_command("set_time", time.asctime())
-                self._buttons["Connection"].setText("Disconnection")
-                for b in self._buttons.values():
-                    b.setEnabled(True)
-                self._read()
-            except (ConnectionError, ConnectionRefusedError):
-                logger.warning("Connection failed")
+        self._buttons["Connection"].setEnabled(False)
+        if self._connected:
+            self._status.setText("Disconnecting...")
+            self.disconnect_board.emit()
+        else:
+            self._status.setText("Connecting...")
+            self.connect_board.emit(download_cursor(self._state))
+
+    def _on_connected(self):
+        """
+        The board is reading and the activities are being downloaded
+        :return:
+        """
+        self._connected = True
+        self._status.setText("Connected")
+        self._buttons["Connection"].setText("Disconnection")
+        self._set_buttons(True)
+        self._buttons["Read Tag"].setEnabled(False)
+
+    def _on_disconnected(self):
+        self._connected = False
+        self._status.setText("")
+        self._buttons["Connection"].setText("Connection")
+        self._set_buttons(False)
+
+    def _on_failed(self, message: str):
+        self._status.setText(message)
+        self._end_download()
+        if self.service.is_closed:
+            self._on_disconnected()
         else:
-            self.channel.disconnect()
-            self._buttons["Connection"].setText("Connection")
-            for b in self._buttons.values():
-                b.setEnabled(b.text() == "Connection")
+            self._buttons["Connection"].setEnabled(True)
 
     def _read(self):
         self._buttons.get("Read Tag").setEnabled(False)
         self._buttons.get("Write Tag").setEnabled(True)
-        self.channel.send_command("read", None)
+        self.send.emit("read", None)
 
     def _write(self):
         self._buttons.get("Read Tag").setEnabled(True)
@@ -71,23 +228,93 @@ class Window(QMainWindow):
         dialog = NameDialog()
         task_name = dialog.name
         if task_name is not None and not task_name == '':
-            self.channel.send_command("write", task_name)
+            self.send.emit("write", task_name)
+
+    def _enroll(self):
+        """
+        Registers many tags at once: the board matches the tags presented
+        with the tasks, in order
+        :return:
+        """
+        text, ok = QInputDialog.getMultiLineText(
+            self, "Enroll Tags", "One task per line, in the order of the tags"
+        )
+        tasks = [line.strip() for line in text.splitlines() if line.strip()]
+        if ok and tasks:
+            self.send.emit("enroll", tasks)
+            self._status.setText(f"Present the {len(tasks)} tags in order")
 
     def _download(self):
-        self.channel.send_command("send", "")
-        _, self.worktable = self.channel.read_sensor()
-        logger.info(self.worktable)
-        times, dates, indexes = self.worktable
-        with open(TIMETABLE, 'w', newline='') as csv_file:
+        """
+        Downloads the activities recorded since the last download, the
+        window stays responsive until they are received
+        :return:
+        """
+        self._buttons["Download workload"].setEnabled(False)
+        self._buttons["Cancel"].setEnabled(True)
+        self._progress_bar.setRange(0, 0)  # size unknown until received
+        self._progress_bar.setVisible(True)
+        self._status.setText("Downloading...")
+        self.download.emit(download_cursor(self._state))
+
+    def _cancel(self):
+        self._buttons["Cancel"].setEnabled(False)
+        self.service.cancel()
+
+    def _on_progress(self, received: int):
+        self._status.setText(f"Downloading... {received // 1024} kB")
+
+    def _end_download(self):
+        self._progress_bar.setVisible(False)
+        self._buttons["Cancel"].setEnabled(False)
+        self._buttons["Download workload"].setEnabled(self._connected)
+
+    def _on_downloaded(self, data):
+        """
+        Merges the downloaded activities in the local store. Only the
+        finished activities are appended to the timetable, the running one is
+        exported once it is over. A reset history of the board is appended
+        after the activities already downloaded.
+        :param data: the reply of the board to the send command
+        :return:
+        """
+        self._end_download()
+        records = data["records"]
+        logger.info(
+            f"{len(records)} activities downloaded from {data['start']}"
+        )
+        self._status.setText(f"{len(records)} activities downloaded")
+        start = merge_download(self._state, data)
+        self.analytics.merge(start, records)
+        exported = self._state["exported"]
+        finished = self._state["offset"] + self._state["cursor"]
+        mode = 'a' if exported else 'w'
+        with open(TIMETABLE, mode, newline='') as csv_file:
             csv_writer = csv.writer(csv_file, delimiter=',')
-            for task, date, duration in zip(indexes, dates, times):
-                csv_writer.writerow([task, date, duration])
+            for index in range(exported, finished):
+                task, start, duration = self.worktable[index]
+                csv_writer.writerow(
+                    [task, time.asctime(time.localtime(start)), duration]
+                )
+        self._state["exported"] = finished
+        save_local_store(self._state)
+
+    def _export(self):
+        from export import export_all  # NumPy, only needed to export
+        export_all(self.worktable)
+        self._status.setText(f"{len(self.worktable)} activities exported")
 
     def _stop_reading(self):
-        self.channel.send_command("stop", "update")
+        self.send.emit("stop", "update")
         self._buttons.get("Read Tag").setEnabled(True)
         self._buttons.get("Write Tag").setEnabled(True)
 
+    def closeEvent(self, event):
+        self.service.cancel()
+        self._service_thread.quit()
+        self._service_thread.wait()
+        super(Window, self).closeEvent(event)
+
 
 class NameDialog(QDialog):
     task_name = None
@@ -0,0 +1,117 @@
+#  Hardware-free stand-ins for the RFID device and the Bluetooth link, to run
+#  the board client and the channel on any computer. The channel goes over a
+#  TCP loopback connection instead of RFCOMM.
+
+import socket
+import threading
+import time
+
+from client import Client, READER_SETTINGS
+from communication import CommunicationChannel
+from rfid_reader import TagReader
+from task_registry import TaskRegistry
+from transport import TcpTransport
+
+FAKE_MAC = "00:00:00:00:00:00"
+
+
+class FakeRFID:
+    """
+    Stands in for pirc522.RFID: a tag is put on the reader with `present` and
+    taken away with `remove`
+    """
+
+    def __init__(self):
+        self._uid = None
+        self._tag_present = threading.Event()
+        self.presented_at = None  # monotonic time of the last presentation
+
+    def present(self, uid: list):
+        self._uid = list(uid)
+        self.presented_at = time.monotonic()
+        self._tag_present.set()
+
+    def remove(self):
+        self._uid = None
+        self._tag_present.clear()
+
+    def wait_for_tag(self, timeout=0):
+        self._tag_present.wait(timeout or None)
+
+    def request(self):
+        return self._uid is None, 0x10
+
+    def anticoll(self):
+        uid = self._uid
+        return uid is None, uid
+
+    def cleanup(self):
+        self.remove()
+
+
+class FakePCBluetoothManager:
+    name_mac = {"RFIDTIMETRACKER": FAKE_MAC}
+
+    def get_mac_address(self):
+        return FAKE_MAC
+
+    def get_mac_addresses(self) -> dict:
+        return dict(self.name_mac)
+
+    @property
+    def macs(self):
+        return self.name_mac.values()
+
+    @property
+    def names(self) -> list:
+        return list(self.name_mac.keys())
+
+
+class FakeBoardBluetoothManager:
+    mac = FAKE_MAC
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LoopbackChannel(CommunicationChannel):
+    """
+    CommunicationChannel over a TCP connection on the loopback interface
+    """
+
+    def __init__(self, side='PC', port=None, host='127.0.0.1'):
+        super(LoopbackChannel, self).__init__(
+            side,
+            FakePCBluetoothManager() if side == 'PC'
+            else FakeBoardBluetoothManager(),
+            TcpTransport(host, port)
+        )
+
+
+class SimulatedClient(Client):
+    """
+    Board client running on a FakeRFID, reachable through a LoopbackChannel.
+    Its files are written in the current directory, as on the board.
+    """
+
+    def __init__(self, port=None, reader_settings=None):
+        self.port = port or free_port()
+        self._reader_settings = reader_settings or READER_SETTINGS
+        super(SimulatedClient, self).__init__()
+
+    def _setup_rfid(self):
+        self.rc522 = FakeRFID()
+        self.reader = TagReader(self.rc522, **self._reader_settings)
+        self._lookup_table = TaskRegistry()
+
+    def _setup_channel(self):
+        self.channel = LoopbackChannel('Board', self.port)
+
+    def pc_channel(self) -> LoopbackChannel:
+        """
+        :return: a PC side channel to reach this board
+        """
+        return LoopbackChannel('PC', self.port)
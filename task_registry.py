@@ -0,0 +1,233 @@
+import ast
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from logger import logger
+from metrics import metrics
+
+LOOKUP_FILE = "lookup_table.pkl"  # former lookup table, migrated once
+REGISTRY_FILE = "task_registry.log"
+
+debug_uid = [136, 4, 114, 215, 41]
+
+_UID_SIZE = 5
+_RECORD = struct.Struct('<5sH')  # packed uid, length of the task name
+_CRC = struct.Struct('<L')
+
+
+class TaskRegistry:
+    """
+    Registry matching the uid of a tag with the name of its task. The uids
+    are packed in 5-byte integers, so a lookup is a plain dict access. On disk
+    the registry is an append-only log of (uid, task) records: registering a
+    tag appends one record instead of rewriting the whole table, and the last
+    record of an uid wins. The log is rewritten only when most of its records
+    are outdated.
+    """
+
+    def __init__(self, path=REGISTRY_FILE, legacy_path=LOOKUP_FILE):
+        self.path = path
+        self._tasks = dict()
+        self._records = 0
+        if os.path.isfile(path):
+            self._load()
+        elif os.path.isfile(legacy_path):
+            self._migrate(legacy_path)
+        else:
+            self.register(debug_uid, "DEBUG")
+
+    @staticmethod
+    def key(uid) -> int:
+        """
+        :param uid: the uid of a tag, as read by the RFID device
+        :return: the uid packed in an integer
+        """
+        return int.from_bytes(bytes(uid[:_UID_SIZE]), 'big')
+
+    @staticmethod
+    def uid(key: int) -> list:
+        return list(key.to_bytes(_UID_SIZE, 'big'))
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        offset = 0
+        while offset + _RECORD.size <= len(content):
+            packed_uid, length = _RECORD.unpack_from(content, offset)
+            end = offset + _RECORD.size + length
+            if end + _CRC.size > len(content):
+                break
+            crc, = _CRC.unpack_from(content, end)
+            if crc != zlib.crc32(content[offset:end]):
+                break
+            task = content[offset + _RECORD.size:end].decode()
+            self._tasks[int.from_bytes(packed_uid, 'big')] = task
+            self._records += 1
+            offset = end + _CRC.size
+        if offset < len(content):
+            logger.warning(
+                f"Dropping {len(content) - offset} bytes of torn registry"
+            )
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+        if self._records > 2 * len(self._tasks) + 100:
+            self._rewrite()
+
+    def _migrate(self, legacy_path):
+        with open(legacy_path, 'rb') as f:
+            lookup_table = pickle.load(f)
+        self.register_many(
+            (ast.literal_eval(uid), task)
+            for uid, task in lookup_table.items()
+        )
+        logger.info(f"{len(self._tasks)} tasks migrated from {legacy_path}")
+
+    @staticmethod
+    def _record(key: int, task: str) -> bytes:
+        x = task.encode()
+        record = _RECORD.pack(key.to_bytes(_UID_SIZE, 'big'), len(x)) + x
+        return record + _CRC.pack(zlib.crc32(record))
+
+    def _append(self, records: bytes):
+        with metrics.timer("registry.write"), open(self.path, 'ab') as f:
+            f.write(records)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(
+                self._record(key, task) for key, task in self._tasks.items()
+            ))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._records = len(self._tasks)
+
+    def register(self, uid, task: str):
+        """
+        Matches an uid with a task
+        :param uid: the uid of the tag
+        :param task: the task it is associated to
+        :return:
+        """
+        self.register_many(((uid, task),))
+
+    def register_many(self, pairs):
+        """
+        Matches several uids with their tasks, written to disk at once
+        :param pairs: the (uid, task) pairs
+        :return:
+        """
+        records = []
+        for uid, task in pairs:
+            key = self.key(uid)
+            self._tasks[key] = task
+            records.append(self._record(key, task))
+        if records:
+            self._append(b''.join(records))
+            self._records += len(records)
+
+    def get(self, uid, default=None):
+        if uid is None:
+            return default
+        return self._tasks.get(self.key(uid), default)
+
+    def __contains__(self, uid):
+        return self.key(uid) in self._tasks
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def items(self):
+        """
+        :return: the (uid, task) pairs
+        """
+        return [(self.uid(key), task) for key, task in self._tasks.items()]
+
+
+class Enrollment:
+    """
+    Registration of many tags in a row: the tags presented are matched with
+    a list of tasks, in order. The registry is written once, when every task
+    has its tag or when the enrollment is stopped.
+    """
+
+    def __init__(self, registry: TaskRegistry, tasks):
+        """
+        :param registry: the registry to write the tags to
+        :param tasks: the names of the tasks, in the order of the tags
+        """
+        self._registry = registry
+        self._tasks = list(tasks)
+        self._pairs = []
+        self._keys = set()  # of the enrolled tags
+        self._timings = []
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._last = self._started
+        self.done = not self._tasks
+
+    def assign(self, uid, detected_at: float):
+        """
+        Matches a tag with the next task
+        :param uid: the uid of the tag
+        :param detected_at: the monotonic time of the first read of the tag
+        :return: the task, None if the tag was already enrolled or if there
+        is no task left
+        """
+        with self._lock:
+            key = TaskRegistry.key(uid)
+            if self.done or key in self._keys:
+                return None
+            task = self._tasks[len(self._pairs)]
+            now = time.monotonic()
+            self._pairs.append((uid, task))
+            self._keys.add(key)
+            # latency of the tag, and time since the previous tag
+            self._timings.append((now - detected_at, now - self._last))
+            self._last = now
+            if len(self._pairs) == len(self._tasks):
+                self._finish()
+            return task
+
+    def stop(self):
+        """
+        Ends the enrollment, the tags enrolled so far are registered
+        :return:
+        """
+        with self._lock:
+            if not self.done:
+                self._finish()
+
+    def _finish(self):
+        self._registry.register_many(self._pairs)
+        self.done = True
+        logger.info(
+            f"{len(self._pairs)} tags enrolled in "
+            f"{time.monotonic() - self._started:.1f} s"
+        )
+
+    def report(self) -> dict:
+        """
+        :return: whether the enrollment is over, the tasks still without tag
+        and, for each enrolled tag, its uid, its task, the latency from its
+        first read to its enrollment and the time since the previous tag, in
+        seconds
+        """
+        with self._lock:
+            return {
+                "done": self.done,
+                "pending": self._tasks[len(self._pairs):],
+                "enrolled": [
+                    {"uid": uid, "task": task, "latency": latency,
+                     "interval": interval}
+                    for (uid, task), (latency, interval)
+                    in zip(self._pairs, self._timings)
+                ],
+            }
@@ -0,0 +1,208 @@
+import os
+import socket
+import time
+from urllib.parse import urlparse
+
+from logger import logger
+
+TIMEOUT_CONNECT = 15
+_BT_PORT = 4
+_TCP_PORT = 4242
+
+
+class Transport:
+    """
+    How the sockets of a channel are made: the PC side connects to the board,
+    the board side accepts the connection of the PC. The channel only sees a
+    connected stream socket, whatever the transport.
+    """
+
+    def make_socket(self) -> socket.socket:
+        raise NotImplementedError
+
+    @property
+    def address(self):
+        """
+        The address the PC connects to, and the board listens on
+        """
+        raise NotImplementedError
+
+    def configure(self, _socket: socket.socket):
+        """
+        Sets the options of a connected socket
+        """
+        pass
+
+    def _prepare_listen(self):
+        pass
+
+    def connect(self, timeout=TIMEOUT_CONNECT) -> socket.socket:
+        """
+        PC side: connects to the board
+        :return: the connected socket
+        """
+        try:
+            _socket = self._try_connect(timeout)
+        except Exception as err:
+            logger.warning(f' [failed: {err!r}]')
+            raise ConnectionRefusedError from err
+        logger.info(' [connected]')
+        self.configure(_socket)
+        return _socket
+
+    def _try_connect(self, timeout) -> socket.socket:
+        """
+        Connects to the board, without logging the failures
+        :return: the connected socket
+        """
+        _socket = self.make_socket()
+        _socket.settimeout(timeout)
+        try:
+            _socket.connect(self.address)
+        except Exception:
+            _socket.close()
+            raise
+        return _socket
+
+    def listen(self) -> socket.socket:
+        """
+        Board side: makes the listening socket
+        :return: the socket, bound and listening
+        """
+        self._prepare_listen()
+        _socket = self.make_socket()
+        _socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        _socket.bind(self.address)
+        _socket.listen(1)
+        return _socket
+
+    def accept(self) -> socket.socket:
+        """
+        Board side: waits for the PC to connect
+        :return: the accepted socket
+        """
+        _socket = self.listen()
+        try:
+            connection, _ = _socket.accept()
+        finally:
+            _socket.close()
+        self.configure(connection)
+        return connection
+
+
+class RfcommTransport(Transport):
+    """
+    Bluetooth RFCOMM, the MAC address is the one of the board, given by the
+    Bluetooth manager of the side
+    """
+
+    def __init__(self, bluetooth_manager=None, mac=None, port=_BT_PORT):
+        self.bluetooth_manager = bluetooth_manager
+        self.mac = mac
+        self.port = port
+
+    def make_socket(self) -> socket.socket:
+        _socket = socket.socket(
+            socket.AF_BLUETOOTH,
+            socket.SOCK_STREAM,
+            socket.BTPROTO_RFCOMM
+        )
+        _socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return _socket
+
+    @property
+    def address(self):
+        mac = self.mac
+        if mac is None:
+            if hasattr(self.bluetooth_manager, "get_mac_address"):
+                mac = self.bluetooth_manager.get_mac_address()
+            else:
+                mac = self.bluetooth_manager.mac
+        return mac, self.port
+
+    def connect(self, timeout=TIMEOUT_CONNECT) -> socket.socket:
+        # the known address is tried first, a scan is done only if it fails
+        try:
+            return super(RfcommTransport, self).connect(timeout)
+        except ConnectionRefusedError:
+            if self.mac is not None \
+                    or not hasattr(self.bluetooth_manager, "rescan"):
+                raise
+            known = self.address
+            self.bluetooth_manager.rescan()
+            if self.address == known:
+                raise
+            return super(RfcommTransport, self).connect(timeout)
+
+
+class TcpTransport(Transport):
+    """
+    TCP, over Wi-Fi, USB gadget Ethernet or the loopback interface
+    """
+
+    def __init__(self, host='127.0.0.1', port=_TCP_PORT):
+        self.host = host
+        self.port = port
+
+    def make_socket(self) -> socket.socket:
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    def configure(self, _socket: socket.socket):
+        _socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _try_connect(self, timeout) -> socket.socket:
+        deadline = time.monotonic() + timeout
+        while True:  # the board may not listen yet
+            try:
+                return super(TcpTransport, self)._try_connect(timeout)
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(.05)
+
+
+class UnixTransport(Transport):
+    """
+    Unix domain socket, for local tests
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def make_socket(self) -> socket.socket:
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    @property
+    def address(self):
+        return self.path
+
+    def _prepare_listen(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def transport_from_url(url: str, bluetooth_manager=None) -> Transport:
+    """
+    :param url: rfcomm://MAC[:port], tcp://host[:port] or unix:///path, None
+    for RFCOMM with the MAC address given by the Bluetooth manager
+    :param bluetooth_manager: the Bluetooth manager, for RFCOMM
+    :return: the transport
+    """
+    if url is None:
+        return RfcommTransport(bluetooth_manager)
+    parsed = urlparse(url)
+    if parsed.scheme == "rfcomm":
+        mac, _, port = parsed.netloc.rpartition(':') \
+            if parsed.netloc.count(':') == 6 else (parsed.netloc, '', '')
+        return RfcommTransport(
+            bluetooth_manager, mac or None, int(port or _BT_PORT)
+        )
+    if parsed.scheme == "tcp":
+        return TcpTransport(parsed.hostname, parsed.port or _TCP_PORT)
+    if parsed.scheme == "unix":
+        return UnixTransport(parsed.path)
+    raise ValueError(f"unknown transport {url}")
@@ -1,3 +1,16 @@
+#  Deployment of the board code, to one board or to the whole fleet at once.
+#  Only the files whose hash differs on the board are sent, all in one
+#  archive.
+#  usage: python upload_files.py [board address ...]
+
+import hashlib
+import io
+import shlex
+import sys
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from paramiko.client import SSHClient, AutoAddPolicy
 from logger import logger
 
@@ -6,33 +19,151 @@ RobotPort = 22
 RobotID = 'pi'
 RobotPW = 'raspberry'
 
+# files run by the board
+BOARD_FILES = [
+    "client.py", "async_client.py", "logger.py", "bluetooth_manager.py",
+    "communication.py", "async_communication.py", "transport.py",
+    "framing.py", "codec.py", "activity_store.py", "journal.py",
+    "task_registry.py", "rfid_reader.py", "metrics.py",
+]
+MAX_CONNECTIONS = 8  # boards deployed at once
+
 
 class BoardConnection(SSHClient):
-    def __init__(self):
+    def __init__(self, host=RobotIP, port=RobotPort, user=RobotID,
+                 password=RobotPW):
         super(BoardConnection, self).__init__()
         self.set_missing_host_key_policy(AutoAddPolicy)
-        self.connect(RobotIP, RobotPort, RobotID, RobotPW)
+        self.connect(host, port, user, password)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
-        return True
+        return False
+
+    def run(self, command: str, data=None) -> bytes:
+        """
+        Runs a command on the board
+        :param command: the shell command
+        :param data: bytes to send to the standard input of the command
+        :return: the standard output of the command
+        """
+        stdin, stdout, stderr = self.exec_command(command)
+        if data is not None:
+            stdin.write(data)
+        stdin.channel.shutdown_write()
+        output = stdout.read()
+        if stdout.channel.recv_exit_status():
+            raise RuntimeError(
+                f"{command} failed: {stderr.read().decode().strip()}"
+            )
+        return output
+
+
+def local_hashes(files) -> dict:
+    """
+    :param files: paths of the files
+    :return: the SHA-256 of each file, by path
+    """
+    hashes = dict()
+    for file in files:
+        with open(file, 'rb') as f:
+            hashes[file] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+
+def remote_hashes(client: BoardConnection, directory: str, files) -> dict:
+    """
+    :return: the SHA-256 of the files on the board, missing files are left
+    out
+    """
+    output = client.run(
+        f"cd {shlex.quote(directory)} && "
+        f"sha256sum {' '.join(map(shlex.quote, files))} 2>/dev/null; true"
+    )
+    hashes = dict()
+    for line in output.decode().splitlines():
+        digest, _, file = line.partition('  ')
+        hashes[file] = digest
+    return hashes
+
+
+def archive(files) -> bytes:
+    """
+    :return: a gzipped tar of the files, to be extracted in one command
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for file in files:
+            tar.add(file)
+    return buffer.getvalue()
+
+
+def deploy(host: str, hashes: dict, user=RobotID, password=RobotPW) -> dict:
+    """
+    Uploads the files that changed to a board
+    :param host: the address of the board
+    :param hashes: the SHA-256 of the files to deploy, by path
+    :param user: the user on the board, its home is the target directory
+    :param password: the password of the user
+    :return: the status, the number of uploaded and skipped files and the
+    time of each step
+    """
+    report = {"status": "ok", "uploaded": 0, "skipped": 0}
+    directory = f"/home/{user}"
+    tic = time.perf_counter()
+    try:
+        with BoardConnection(host, RobotPort, user, password) as client:
+            report["connect"] = time.perf_counter() - tic
+            tic = time.perf_counter()
+            on_board = remote_hashes(client, directory, hashes)
+            changed = [f for f, h in hashes.items() if on_board.get(f) != h]
+            report["hash"] = time.perf_counter() - tic
+            report["skipped"] = len(hashes) - len(changed)
+            if changed:
+                tic = time.perf_counter()
+                client.run(
+                    f"tar xzf - -C {shlex.quote(directory)}", archive(changed)
+                )
+                report["upload"] = time.perf_counter() - tic
+                report["uploaded"] = len(changed)
+    except Exception as err:
+        logger.warning(f"Deployment to {host} failed")
+        logger.exception(err)
+        report["status"] = f"failed: {err!r}"
+    return report
 
 
-def upload_code():
-    # Copy Python files to the Raspberry
+def upload_code(hosts=(RobotIP,), files=BOARD_FILES,
+                max_connections=MAX_CONNECTIONS) -> dict:
+    """
+    Deploys the board code to several boards concurrently
+    :param hosts: the addresses of the boards
+    :param files: the files to deploy
+    :param max_connections: the maximum number of boards deployed at once
+    :return: the report of each board, by address
+    """
     logger.info('Upload code...')
-    file_list = [
-        "client.py", "logger.py", "bluetooth_manager.py", "communication.py"
-    ]
-    with BoardConnection() as client:
-        with client.open_sftp() as scp:
-            for file in file_list:
-                scp.put(file, f"/home/{RobotID}/{file}")
-    logger.info('Board code successfully uploaded !')
+    hashes = local_hashes(files)
+    with ThreadPoolExecutor(max_workers=max_connections) as executor:
+        reports = dict(zip(
+            hosts, executor.map(lambda host: deploy(host, hashes), hosts)
+        ))
+    for host, report in reports.items():
+        timings = ", ".join(
+            f"{step} {report[step]:.2f} s"
+            for step in ("connect", "hash", "upload") if step in report
+        )
+        logger.info(
+            f"{host}: {report['status']}, {report['uploaded']} uploaded, "
+            f"{report['skipped']} unchanged ({timings})"
+        )
+    if all(report["status"] == "ok" for report in reports.values()):
+        logger.info('Board code successfully uploaded !')
+    return reports
 
 
 if __name__ == '__main__':
-    upload_code()
+    upload_code(sys.argv[1:] or (RobotIP,))